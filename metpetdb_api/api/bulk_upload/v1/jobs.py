@@ -0,0 +1,202 @@
+"""
+Bulk upload jobs
+
+Uploads submitted with `async` are stored as BulkUpload rows with status
+`queued`; the bulk_uploads table is the queue, so no broker is needed.
+Worker processes started by the `run_bulk_upload_workers` management
+command claim queued jobs one at a time with `FOR UPDATE SKIP LOCKED`, so
+any number of workers (on any number of hosts) can share the queue without
+handing out a job twice. A running job's worker touches its heartbeat
+every HEARTBEAT_INTERVAL seconds; a job whose heartbeat is older than
+STALE_AFTER seconds is taken to have lost its worker and is handed out
+again. Its rows were saved in a transaction that died with the worker, so
+running it again is safe; but a job that took its worker down MAX_ATTEMPTS
+times is marked failed instead.
+
+While a job runs, its progress is written through a separate autocommit
+connection: the rows themselves are saved in a single transaction, which
+would otherwise hide the progress from pollers until the very end.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import psycopg2
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from api.bulk_upload.v1.processing import BulkUploadProcessor
+from apps.samples.models import BulkUpload
+
+logger = logging.getLogger(__name__)
+
+# seconds an idle worker waits before polling the queue again
+POLL_INTERVAL = 2
+
+# rows processed between two progress updates
+PROGRESS_INTERVAL = 50
+
+# seconds between two heartbeats of a running job
+HEARTBEAT_INTERVAL = 30
+
+# seconds without a heartbeat after which a running job is handed out again
+STALE_AFTER = 10 * HEARTBEAT_INTERVAL
+
+# times a job is handed out before it's given up on
+MAX_ATTEMPTS = 3
+
+
+def enqueue(owner, template, url=None, data=None):
+    return BulkUpload.objects.create(owner=owner,
+                                     template=template,
+                                     url=url,
+                                     data=data,
+                                     status=BulkUpload.QUEUED)
+
+
+def claim_next_job():
+    """
+    Marks the oldest queued job, or running job whose worker stopped
+    sending heartbeats, as running and returns it, or returns None if
+    there is no such job. Jobs whose worker stopped on each of their
+    MAX_ATTEMPTS attempts are marked failed.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=STALE_AFTER)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE bulk_uploads
+                SET status = %s, error = %s, finished = %s
+                WHERE status = %s
+                AND COALESCE(heartbeat, started) < %s
+                AND attempts >= %s
+            """, [BulkUpload.FAILED,
+                  'The upload stopped its worker {} times'
+                  .format(MAX_ATTEMPTS),
+                  now,
+                  BulkUpload.RUNNING, stale, MAX_ATTEMPTS])
+
+            cursor.execute("""
+                UPDATE bulk_uploads
+                SET status = %s, started = %s, heartbeat = %s,
+                    processed_rows = 0, attempts = attempts + 1
+                WHERE id = (
+                    SELECT id
+                    FROM bulk_uploads
+                    WHERE status = %s
+                       OR (status = %s AND
+                           COALESCE(heartbeat, started) < %s AND
+                           attempts < %s)
+                    ORDER BY created
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id
+            """, [BulkUpload.RUNNING, now, now,
+                  BulkUpload.QUEUED,
+                  BulkUpload.RUNNING, stale, MAX_ATTEMPTS])
+            row = cursor.fetchone()
+
+    if row is None:
+        return None
+    return BulkUpload.objects.get(pk=row[0])
+
+
+class JobProgress:
+    """
+    Records the progress of a job, and its heartbeat, outside of the
+    transaction the job's rows are saved in.
+    """
+
+    def __init__(self, job, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.job = job
+        self.processed = 0
+        self.total = None
+        self.connection = psycopg2.connect(
+            **connection.get_connection_params())
+        self.connection.autocommit = True
+        # the connection is shared with the heartbeat thread
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeats = threading.Thread(target=self.beat, daemon=True)
+        self.heartbeats.start()
+
+    def __call__(self, processed, total):
+        self.processed = processed
+        if total != self.total or processed % PROGRESS_INTERVAL == 0:
+            self.total = total
+            self.execute("""
+                UPDATE bulk_uploads
+                SET processed_rows = %s, total_rows = %s
+                WHERE id = %s
+            """, [processed, total, self.job.pk])
+
+    def beat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.execute("""
+                    UPDATE bulk_uploads
+                    SET heartbeat = %s
+                    WHERE id = %s
+                """, [timezone.now(), self.job.pk])
+            except psycopg2.Error:
+                logger.exception('Heartbeat of bulk upload #%s failed',
+                                 self.job.pk)
+
+    def execute(self, sql, params):
+        with self.lock, self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeats.join()
+        self.connection.close()
+
+
+def run_job(job):
+    progress = JobProgress(job)
+    processor = BulkUploadProcessor(str(job.owner_id),
+                                    job.template,
+                                    progress=progress)
+    try:
+        result, status_code = processor.process(url=job.url, JSON=job.data)
+    except Exception as err:
+        logger.exception('Bulk upload #%s failed', job.pk)
+        job.status = BulkUpload.FAILED
+        job.error = str(err)
+    else:
+        job.result = result
+        job.status = (BulkUpload.SUCCEEDED if status_code == 201
+                      else BulkUpload.FAILED)
+    finally:
+        progress.close()
+
+    job.processed_rows = progress.processed
+    job.total_rows = progress.total
+    job.finished = timezone.now()
+    # job.data has been consumed by the processor; leave it as submitted
+    job.save(update_fields=['status', 'result', 'error', 'processed_rows',
+                            'total_rows', 'finished'])
+    return job
+
+
+def work(poll_interval=POLL_INTERVAL, once=False):
+    """
+    Runs queued jobs until interrupted; with `once`, returns as soon as the
+    queue is empty instead.
+    """
+    # connections must not be shared with the process this one was forked
+    # from
+    connections.close_all()
+
+    while True:
+        job = claim_next_job()
+        if job is not None:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
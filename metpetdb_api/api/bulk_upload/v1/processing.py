@@ -0,0 +1,512 @@
+import codecs
+import urllib.request
+import uuid
+from csv import reader
+from functools import partial
+
+from django.contrib.postgres.fields import ArrayField
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.db.models import CharField, TextField
+from rest_framework import status
+
+from api.bulk_upload.v1 import upload_templates
+from api.chemical_analyses.v1.serializers import CHEMICAL_ANALYSIS_FIELDS
+from api.lib.vocabulary import VOCABULARIES, vocabulary
+from api.samples.lib import search_cache
+from api.samples.lib.references import georeference_ids
+from api.samples.v1.serializers import SAMPLE_FIELDS
+from apps.chemical_analyses.models import (
+    ChemicalAnalysis,
+    ChemicalAnalysisElement,
+    ChemicalAnalysisOxide,
+    Element,
+    Oxide,
+)
+from apps.samples.models import (
+    MetamorphicGrade,
+    MetamorphicRegion,
+    Mineral,
+    RockType,
+    Sample,
+    SampleMineral,
+    Subsample,
+)
+from apps.samples.regions import assign_metamorphic_regions
+
+# rows written per INSERT by the bulk upload paths
+BATCH_SIZE = 1000
+
+# bytes read at a time from an uploaded file or url
+CHUNK_SIZE = 64 * 1024
+
+
+def normalize_uuid(value):
+    """
+    Returns the canonical form of a UUID string, or None if it isn't one.
+    """
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+def read_lines(chunks, encoding='utf-8'):
+    """
+    Decodes an iterable of byte chunks incrementally and yields its lines,
+    line endings included, so that only a chunk and a line are in memory at
+    a time.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+class Parser:
+    """
+    Feeds the rows of a CSV file to a template as they are read, rather
+    than reading, decoding and splitting the whole file up front.
+    """
+    def __init__(self, template):
+        self.template = template
+
+    def parse_chunks(self, chunks):
+        try:
+            return self.template.parse(reader(read_lines(chunks)))
+        except Exception as err:
+            raise ValueError(str(err))
+
+    # Effects: Generates JSON file from passed template
+    def parse(self, url):
+        try:
+            url = url[:-1] +'1' # specific to dropBox urls
+            response = urllib.request.urlopen(url)
+        except Exception as err:
+            raise ValueError(str(err))
+
+        with response:
+            return self.parse_chunks(iter(partial(response.read, CHUNK_SIZE),
+                                          b''))
+
+    def parse_file(self, upload):
+        return self.parse_chunks(upload.chunks(CHUNK_SIZE))
+
+
+class BulkUploadProcessor:
+    """
+    Validates and saves the rows of a bulk upload.
+
+    This is independent of any request, so that an upload can be processed
+    either synchronously by BulkUploadViewSet or by a bulk upload worker
+    (see api.bulk_upload.v1.jobs). `process` returns the rows (annotated
+    with their errors) and the HTTP status describing the outcome; problems
+    with the upload as a whole are raised as ValueError.
+
+    `progress`, if given, is called with (processed rows, total rows) as
+    the rows get saved.
+    """
+
+    def __init__(self, owner, template_name, progress=None):
+        self.owner = owner
+        self.template_name = template_name
+        self.progress = progress or (lambda processed, total: None)
+
+    def get_template(self):
+        #Dynamically generate instance of template
+        try:
+            module = upload_templates
+            class_ = getattr(module, self.template_name)
+            return class_()
+        except:
+            raise ValueError('invalid template')
+
+    def process(self, url=None, JSON=None, file=None):
+        template_instance = self.get_template()
+
+        #JSON received, update accordingly
+        if JSON:
+            meta_header = JSON[-1]['meta_header']
+            del JSON[-1]
+            # clear out the old errors
+            for obj in JSON:
+                obj['errors'] = {}
+            # TODO perform simple verification of fields for template type
+
+        # Parse the input for basic errors
+        # These are errors that are catchable without the data model
+        elif file:
+            p = Parser(template_instance)
+            JSON,meta_header = p.parse_file(file)
+        else:
+            p = Parser(template_instance)
+            JSON,meta_header = p.parse(url)
+
+        for obj in JSON:
+            if len(obj['errors']) > 0:
+                JSON.append({"meta_header": meta_header})
+                return JSON, status.HTTP_400_BAD_REQUEST
+
+        if self.template_name == 'SampleTemplate':
+            return self.parse_samples(JSON, meta_header)
+
+        elif self.template_name == 'ChemicalAnalysesTemplate':
+            return self.parse_chemical_analyses(JSON, meta_header)
+
+        else:
+            raise ValueError('invalid template')
+
+    def lookup(self, model, field, values):
+        """
+        Maps each of `values` that exists in `field` of `model` to the pk of
+        its row, from the vocabulary cache or else with a single query.
+        """
+        if model in VOCABULARIES:
+            return vocabulary(model).lookup(field, values)
+
+        values = set(str(v) for v in values if v != '')
+        if not values:
+            return {}
+        return {str(value): pk for value, pk in (model
+                                                 .objects
+                                                 .filter(**{field + '__in': values})
+                                                 .values_list(field, 'pk'))}
+
+    def clean_value(self, field, value):
+        if isinstance(field, ArrayField):
+            if value in ('', None):
+                return None
+            return value if isinstance(value, list) else [value]
+        if value == '' and field.null and not isinstance(field,
+                                                         (CharField,
+                                                          TextField)):
+            return None
+        return value
+
+    def build_sample(self, sample_obj, rock_type_id):
+        """
+        Builds an unsaved Sample from an upload row; raises ValidationError
+        if any of its fields are invalid.
+        """
+        values = dict(sample_obj)
+
+        # Need this for a proper collection date
+        if values.get('collection_date'):
+            values['collection_date'] += 'T00:00:00.000Z'
+
+        if 'latitude' in values and 'longitude' in values:
+            values['location_coords'] =  u'SRID=4326;POINT ({0} {1})'.format(values['latitude'], values['longitude'])
+
+        return self.build(Sample, SAMPLE_FIELDS, values,
+                          owner_id=self.owner,
+                          rock_type_id=rock_type_id)
+
+    def build_chemical_analysis(self, chemical_analyses_obj, mineral_id):
+        """
+        Builds an unsaved ChemicalAnalysis from an upload row; raises
+        ValidationError if any of its fields are invalid.
+        """
+        values = dict(chemical_analyses_obj)
+
+        #fix date formatting
+        if values.get('analysis_date'):
+            values['analysis_date'] += 'T00:00:00.000Z'
+
+        return self.build(ChemicalAnalysis, CHEMICAL_ANALYSIS_FIELDS, values,
+                          owner_id=self.owner,
+                          subsample_id=values.get('subsample_id'),
+                          mineral_id=mineral_id)
+
+    def build(self, model, names, values, **attrs):
+        """
+        Builds an unsaved `model` instance from the `names` fields present in
+        `values` and the given attributes, and validates its fields without
+        touching the database.
+        """
+        instance = model(**attrs)
+        for name in names:
+            if name in values:
+                field = model._meta.get_field(name)
+                setattr(instance, field.attname,
+                        self.clean_value(field, values[name]))
+
+        instance.clean_fields(
+            exclude=[f.name for f in model._meta.fields
+                     if f.primary_key or f.is_relation or f.name == 'version']
+        )
+        return instance
+
+    def parse_chemical_analyses(self, JSON, meta_header):
+        """
+        Validates every row in memory against vocabularies resolved with one
+        query each, then writes the analyses and their element and oxide
+        amounts with batched inserts.
+        """
+        def values(key):
+            return (value for chemical_analyses_obj in JSON
+                    for value in (chemical_analyses_obj.get(key) or []))
+
+        minerals = self.lookup(Mineral, 'name',
+                               (mineral.get('name')
+                                for mineral in values('mineral')
+                                if isinstance(mineral, dict)))
+        elements = self.lookup(Element, 'name',
+                               (element['name']
+                                for element in values('element')))
+        oxides = self.lookup(Oxide, 'species',
+                             (oxide['name'] for oxide in values('oxide')))
+        subsamples = self.lookup(
+            Subsample, 'pk',
+            (normalize_uuid(chemical_analyses_obj.get('subsample_id'))
+             for chemical_analyses_obj in JSON
+             if normalize_uuid(chemical_analyses_obj.get('subsample_id')))
+        )
+
+        chemical_analyses = []
+        analysis_elements = []
+        analysis_oxides = []
+
+        for chemical_analyses_obj in JSON:
+            errors = chemical_analyses_obj['errors']
+
+            mineral_id = None
+            try:
+                mineral_id = minerals[
+                    chemical_analyses_obj['mineral'][0]['name']]
+            except (KeyError, IndexError, TypeError):
+                # resubmitted rows may carry a null or malformed mineral
+                errors['mineral_id'] = 'invalid mineral'
+
+            subsample_id = chemical_analyses_obj.get('subsample_id')
+            if normalize_uuid(subsample_id) not in subsamples:
+                errors['subsample_id'] = (
+                    'invalid subsample id {0}'.format(subsample_id))
+
+            try:
+                chemical_analysis = self.build_chemical_analysis(
+                    chemical_analyses_obj, mineral_id)
+            except ValidationError as e:
+                errors['serialization'] = str(e)
+                continue
+
+            amounts = self.build_amounts(
+                ChemicalAnalysisElement, 'element', elements,
+                chemical_analysis, chemical_analyses_obj.get('element'),
+                errors)
+            chemical_analysis.element_ids = sorted(set(
+                amount.element_id for amount in amounts))
+            analysis_elements.extend(amounts)
+
+            amounts = self.build_amounts(
+                ChemicalAnalysisOxide, 'oxide', oxides,
+                chemical_analysis, chemical_analyses_obj.get('oxide'),
+                errors)
+            chemical_analysis.oxide_ids = sorted(set(
+                amount.oxide_id for amount in amounts))
+            analysis_oxides.extend(amounts)
+
+            chemical_analyses.append(chemical_analysis)
+
+        if any(len(chemical_analyses_obj['errors']) > 0
+               for chemical_analyses_obj in JSON):
+            JSON.append({"meta_header": meta_header})
+            return JSON, status.HTTP_400_BAD_REQUEST
+
+        try:
+            with transaction.atomic():
+                for start in range(0, len(chemical_analyses), BATCH_SIZE):
+                    ChemicalAnalysis.objects.bulk_create(
+                        chemical_analyses[start:start + BATCH_SIZE])
+                    self.progress(min(start + BATCH_SIZE,
+                                      len(chemical_analyses)),
+                                  len(chemical_analyses))
+
+                ChemicalAnalysisElement.objects.bulk_create(
+                    analysis_elements, batch_size=BATCH_SIZE)
+                ChemicalAnalysisOxide.objects.bulk_create(
+                    analysis_oxides, batch_size=BATCH_SIZE)
+        except DatabaseError as err:
+            raise ValueError(str(err))
+
+        # bulk inserts send no signals
+        search_cache.invalidate_sample_search(self)
+
+        JSON.append({"meta_header": meta_header})
+        return JSON, status.HTTP_201_CREATED
+
+    def build_amounts(self, model, kind, ids, chemical_analysis, records,
+                      errors):
+        """
+        Builds the unsaved element or oxide amount rows (`kind`) of an
+        analysis, recording any invalid ones in `errors`.
+        """
+        instances = []
+        seen = set()
+        for record in records or []:
+            if record['name'] == '':
+                continue
+            id = ids.get(record['name'])
+            if id is None:
+                errors[kind] = 'invalid {0} {1}'.format(kind, record)
+                continue
+            if id in seen:
+                errors[kind] = 'duplicate {0} {1}'.format(kind, record)
+                continue
+            seen.add(id)
+            try:
+                instances.append(self.build(
+                    model, ('amount',), record,
+                    chemical_analysis_id=chemical_analysis.pk,
+                    **{kind + '_id': id}
+                ))
+            except ValidationError:
+                errors[kind] = 'invalid {0} amount {1}'.format(kind, record)
+        return instances
+
+    def parse_samples(self, JSON, meta_header):
+        """
+        Validates every row in memory against vocabularies resolved with one
+        query each, then writes the samples and their minerals, metamorphic
+        regions, metamorphic grades and references with batched inserts.
+        """
+        def values(key):
+            return (value for sample_obj in JSON
+                    for value in (sample_obj.get(key) or []))
+
+        rock_types = self.lookup(RockType, 'name',
+                                 (sample_obj.get('rock_type_name')
+                                  for sample_obj in JSON))
+        minerals = self.lookup(Mineral, 'name',
+                               (mineral['name']
+                                for mineral in values('mineral')))
+        metamorphic_grades = self.lookup(MetamorphicGrade, 'name',
+                                         values('metamorphic_grade'))
+        metamorphic_regions = self.lookup(
+            MetamorphicRegion, 'pk',
+            (normalize_uuid(id) for id in values('metamorphic_region_id')
+             if normalize_uuid(id))
+        )
+
+        SampleRegion = Sample.metamorphic_regions.through
+        SampleGrade = Sample.metamorphic_grades.through
+
+        samples = []
+        sample_minerals = []
+        sample_regions = []
+        sample_grades = []
+        sample_references = []
+
+        for sample_obj in JSON:
+            errors = sample_obj['errors']
+
+            rock_type = sample_obj.get('rock_type_name')
+            rock_type_id = rock_types.get(rock_type)
+            if rock_type_id is None:
+                errors['rock_type_id'] = 'Invalid rock {0}'.format(rock_type)
+
+            mineral_ids = []
+            for mineral in sample_obj.get('mineral') or []:
+                if mineral['name'] == '':
+                    continue
+                try:
+                    mineral_ids.append(minerals[mineral['name']])
+                except KeyError:
+                    errors['minerals'] = 'Invalid mineral {0}'.format(mineral)
+
+            region_ids = []
+            for id in sample_obj.get('metamorphic_region_id') or []:
+                if id == '':
+                    continue
+                try:
+                    region_ids.append(metamorphic_regions[normalize_uuid(id)])
+                except KeyError:
+                    errors['metamorphic_region_ids'] = (
+                        'Invalid metamorphic_region id: {}'.format(id))
+
+            grade_ids = []
+            for grade in sample_obj.get('metamorphic_grade') or []:
+                if grade == '':
+                    continue
+                try:
+                    grade_ids.append(metamorphic_grades[grade])
+                except KeyError:
+                    errors['metamorphic_grades'] = (
+                        'Invalid metamorphic_grade : {}'.format(grade))
+
+            try:
+                sample = self.build_sample(sample_obj, rock_type_id)
+            except ValidationError as e:
+                errors['serialization'] = str(e)
+                continue
+
+            sample.mineral_ids = sorted(set(mineral_ids))
+            samples.append(sample)
+            sample_minerals.extend(
+                SampleMineral(sample_id=sample.pk,
+                              mineral_id=mineral_id,
+                              amount='0')
+                for mineral_id in mineral_ids)
+            sample_regions.extend(
+                SampleRegion(sample_id=sample.pk,
+                             metamorphicregion_id=region_id)
+                for region_id in set(region_ids))
+            sample_grades.extend(
+                SampleGrade(sample_id=sample.pk,
+                            metamorphicgrade_id=grade_id)
+                for grade_id in set(grade_ids))
+            sample_references.extend(
+                (sample.pk, name)
+                for name in set(sample_obj.get('references') or []) if name)
+
+        if any(len(sample_obj['errors']) > 0 for sample_obj in JSON):
+            JSON.append({"meta_header": meta_header})
+            return JSON, status.HTTP_400_BAD_REQUEST
+
+        try:
+            with transaction.atomic():
+                for start in range(0, len(samples), BATCH_SIZE):
+                    Sample.objects.bulk_create(
+                        samples[start:start + BATCH_SIZE])
+                    self.progress(min(start + BATCH_SIZE, len(samples)),
+                                  len(samples))
+
+                SampleMineral.objects.bulk_create(sample_minerals,
+                                                  batch_size=BATCH_SIZE)
+                SampleRegion.objects.bulk_create(sample_regions,
+                                                 batch_size=BATCH_SIZE)
+                SampleGrade.objects.bulk_create(sample_grades,
+                                                batch_size=BATCH_SIZE)
+                self.bulk_add_references(sample_references)
+                assign_metamorphic_regions(
+                    sample_ids=[sample.pk for sample in samples])
+        except DatabaseError as err:
+            raise ValueError(str(err))
+
+        # bulk inserts send no signals
+        search_cache.invalidate_sample_search(self)
+
+        JSON.append({"meta_header": meta_header})
+        return JSON, status.HTTP_201_CREATED
+
+    def bulk_add_references(self, sample_references):
+        """
+        Links samples to their references given as (sample id, name) pairs,
+        creating the references that don't exist yet.
+        """
+        georeferences = georeference_ids(
+            name for sample_id, name in sample_references)
+
+        SampleReference = Sample.references.through
+        SampleReference.objects.bulk_create(
+            [SampleReference(sample_id=sample_id,
+                             georeference_id=georeferences[name])
+             for sample_id, name in sample_references],
+            batch_size=BATCH_SIZE
+        )
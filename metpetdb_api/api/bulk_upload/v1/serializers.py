@@ -0,0 +1,11 @@
+from api.lib.serializers import DynamicFieldsModelSerializer
+from apps.samples.models import BulkUpload
+
+
+class BulkUploadSerializer(DynamicFieldsModelSerializer):
+    class Meta:
+        model = BulkUpload
+        fields = ('id', 'template', 'url', 'status', 'total_rows',
+                  'processed_rows', 'error', 'result', 'created', 'started',
+                  'finished')
+        read_only_fields = fields
@@ -1,10 +1,22 @@
 import json
+from datetime import timedelta
+
+from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework import status
+from django.utils import timezone
 from rest_framework.test import APIClient, APITransactionTestCase
 
+from api.bulk_upload.v1.jobs import (
+    MAX_ATTEMPTS,
+    STALE_AFTER,
+    claim_next_job,
+    enqueue,
+    run_job,
+)
 from apps.users.models import User
 
 from apps.samples.models import (
+    BulkUpload,
     Mineral,
     RockType,
     Sample,
@@ -219,3 +231,78 @@ class BulkUploadTests(APITransactionTestCase):
         res=self.client.post('/api/bulk_upload/', data)
         self.assertEqual(res.status_code, status.HTTP_201_CREATED)
 
+        # the uploaded analyses can be searched by their elements
+        for params, count in (({'elements': 'Argon'}, 2),
+                              ({'elements': 'Argon,Silver'}, 3),
+                              ({'elements': 'Argon,Silver',
+                                'elements_and': 'True'}, 0),
+                              ({'oxides': 'FeO', 'elements': 'Silver',
+                                'oxides_and': 'True'}, 1)):
+            res=self.client.get('/api/chemical_analyses/', params)
+            self.assertEqual(res.data['count'], count)
+
+    def test_bulkupload_samples_from_file(self):
+        """
+        Upload samples from a CSV file rather than a url
+        """
+        content=('number,latitude,longitude,rock_type_name,mineral,mineral\r\n'
+                 '1,7.86210012,46.01432423,Slate,Silica,Quartz\r\n'
+                 '2,12.86210012,13.01432423,Slate,Mica,\r\n')
+        data={'owner' : self.owner,
+              'template' : 'SampleTemplate',
+              'file' : SimpleUploadedFile('samples.csv', content.encode('utf-8'))}
+        res=self.client.post('/api/bulk_upload/', data, format='multipart')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(self.empty_errors(res.data))
+        self.assertEqual(Sample.objects.filter(number__in=['1', '2']).count(), 2)
+
+    def test_async_sample_upload_job(self):
+        """
+        Queue a sample upload as a job, run it and poll its result
+        """
+        data={'owner' : self.owner,
+              'template' : 'SampleTemplate',
+              'async' : True,
+              'json': [{"number":"1","mineral":[{"amount":0,"name":"Silica"},{"amount":0,"name":"Quartz"}],"rock_type_name":"Slate","collection_date":"1999-03-27","latitude":"7.86210012","longitude":"46.01432423","errors":{}},
+                       {"number":"2","mineral":[{"amount":0,"name":"Mica"}],"rock_type_name":"Slate","collection_date":"","latitude":"12.86210012","longitude":"13.01432423","errors":{}},
+                       {"meta_header":[["number","number"],[["latitude","longitude"],"location_coords"],["collection_date","collection_date"],["rock_type_name","rock_type_name"],["mineral","minerals"]]}]}
+        res=self.client.post('/api/bulk_upload/', data)
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(res.data['status'], 'queued')
+        self.assertEqual(Sample.objects.filter(number__in=['1', '2']).count(), 0)
+
+        run_job(claim_next_job())
+        self.assertIsNone(claim_next_job())
+
+        res=self.client.get('/api/bulk_upload/{}/'.format(res.data['id']))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], 'succeeded')
+        self.assertEqual(res.data['processed_rows'], 2)
+        self.assertEqual(res.data['total_rows'], 2)
+        self.assertTrue(self.empty_errors(res.data['result']))
+        self.assertEqual(Sample.objects.filter(number__in=['1', '2']).count(), 2)
+
+    def test_jobs_of_dead_workers_are_claimed_again(self):
+        job = enqueue(None, 'SampleTemplate')
+        self.assertEqual(claim_next_job().pk, job.pk)
+        # the worker is still alive
+        self.assertIsNone(claim_next_job())
+
+        stale = timezone.now() - timedelta(seconds=STALE_AFTER + 1)
+        BulkUpload.objects.filter(pk=job.pk).update(heartbeat=stale)
+        claimed = claim_next_job()
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.status, BulkUpload.RUNNING)
+        self.assertGreater(claimed.heartbeat, stale)
+        self.assertEqual(claimed.attempts, 2)
+
+        # a job that keeps taking its worker down is given up on
+        for attempt in range(MAX_ATTEMPTS - 2):
+            BulkUpload.objects.filter(pk=job.pk).update(heartbeat=stale)
+            self.assertEqual(claim_next_job().pk, job.pk)
+        BulkUpload.objects.filter(pk=job.pk).update(heartbeat=stale)
+        self.assertIsNone(claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, BulkUpload.FAILED)
+        self.assertEqual(job.attempts, MAX_ATTEMPTS)
+
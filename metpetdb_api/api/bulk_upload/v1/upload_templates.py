@@ -24,113 +24,128 @@ All other fields are assumed to be simple, i.e. directly mapped
     e.g. where_done = "Rensselaer Polytechnic Institute"
 
 """
-import copy
-
 class Template:
     def __init__(self, c_types = [], required = [], db_types = [], types = {}): 
         self.complex_types = c_types
         self.required = required 
         self.db_types = db_types
-        self.data = ''
         self.amounts = {'element', 'oxide'}
         self.types = types
 
-    def check_line_len(self):
-        data = self.data
-        if len(data) == 0:
-            raise Exception("empty file")
+    def compile(self, header):
+        """
+        Works out once, from the header, how each column of a row is to be
+        checked and stored, so that every row is handled in a single pass.
+        """
+        self.header = header
+        self.width = len(header)
+
+        self.required_columns = [(j, heading)
+                                 for j, heading in enumerate(header)
+                                 if self.is_required(heading)]
+
+        # headings are stripped of blank spaces to look up their types
+        self.converters = [(j, heading.strip(), self.types[heading.strip()])
+                           for j, heading in enumerate(header)
+                           if heading.strip() in self.types]
+
+        self.columns = []
+        for j, heading in enumerate(header):
+            if heading in self.amounts:
+                kind = 'amount'
+            elif heading == 'mineral':
+                kind = 'mineral'
+            elif self.is_complex(heading):
+                kind = 'complex'
+            else:
+                kind = 'simple'
+            self.columns.append((j, heading, kind))
+
+        self.complex_headings = [heading for heading in header
+                                 if self.is_complex(heading)]
+
+    def check_line_len(self, row):
+        if len(row) != self.width:
+            raise Exception("inconsistent line length. Expected {0}, but was {1}".format(self.width, len(row)))
 
-        for i in range(1,len(data)):
-            if len(data[i]) != len(data[i-1]):
-                raise Exception("inconsistent line length. Expected {0}, but was {1}".format(len(data[i-1]), len(data[i])))
-    
     def check_required(self, row):
-        header = row[0]
         missing ={}
-        for i in range(0, len(header)):
-            if self.is_required(header[i]):
-                if row[1][i] == '':
-                    missing[header[i]] = 'missing'
+        for j, heading in self.required_columns:
+            if row[j] == '':
+                missing[heading] = 'missing'
         return missing
 
-    def check_type(self, curr_row):
+    def check_type(self, row):
         errors = {}
-        header = list(map(lambda x: x.strip(), curr_row[0])) #strip blank spaces from headings
-        for i in range(0,len(header)):
-            if header[i] in self.types.keys():
-                # try to convert the field to the required type  
-                if not isinstance(curr_row[1][i], self.types[header[i]]):
-                    try:
-                        curr_row[1][i] = self.types[header[i]](curr_row[1][i])
-                    except:
-                        errors[header[i]] = '{0} expected'.format(self.types[header[i]].__name__)
+        for j, heading, type_ in self.converters:
+            # try to convert the field to the required type  
+            if not isinstance(row[j], type_):
+                try:
+                    row[j] = type_(row[j])
+                except:
+                    errors[heading] = '{0} expected'.format(type_.__name__)
         return errors
 
-    def check_data(self,curr_row):        
+    def check_data(self, row):
         errors = {}
-        self.check_line_len()
-        
-        req_resp = self.check_required(curr_row)
-        if len(req_resp) > 0:
-            errors.update(req_resp)
-        
-        type_resp = self.check_type(curr_row)
-        if len(type_resp) > 0:
-            errors.update(type_resp)
+        self.check_line_len(row)
+        errors.update(self.check_required(row))
+        errors.update(self.check_type(row))
         return errors
 
-    class TemplateResult:
-        def __init__(self, r_template): 
-            self.rep = r_template
-
-        def set_field_simple(self, field, value): 
-            self.rep[field] = value
-        
-        def set_field_complex(self, field, value):
-            self.rep[field].append(value)
-
-        def get_rep(self): return self.rep
-
+    def build_row(self, row, errors):
+        rep = {heading: '' for heading in self.header}
+        for heading in self.complex_headings:
+            rep[heading] = []
+
+        for j, heading, kind in self.columns:
+            if kind == 'amount':
+                rep[heading].append({"name": row[j],
+                                     "amount": self.get_amount(row, j)})
+            elif kind == 'mineral':
+                rep[heading].append({"name": row[j]})
+            elif kind == 'complex':
+                rep[heading].append(row[j])
+            else:
+                rep[heading] = row[j]
+
+        rep['errors'] = errors
+        return rep
+
+    def parse_rows(self, rows):
+        """
+        Yields the result of each data row as it is read from `rows`; the
+        header has to have been compiled beforehand.
+        """
+        for row in rows:
+            # blank lines carry no data
+            if not row:
+                continue
+            row = list(row)
+            errors = self.check_data(row)
+            yield self.build_row(row, errors)
 
     def parse(self, data):
-        self.data = data
-     
-        header = data[0]
+        """
+        Parses an iterable of rows, the first of which is the header, in a
+        single pass.
+        """
+        rows = iter(data)
+        try:
+            header = next(rows)
+        except StopIteration:
+            raise Exception("empty file")
+
         meta_header = self.get_meta_header(header)
         self.check_amounts(header)
+        self.compile(header)
 
-        result = []
-        result_template = {}
-        for heading in header:
-            if self.is_complex(heading): result_template[heading] = []
-            else: result_template[heading] = ''
-        result_template['errors'] = '';
-        
-        for i in range(1, len(data)):
-            tmp_result = self.TemplateResult(copy.deepcopy(result_template))
-            curr_row = [header, data[i]]
-            errors = self.check_data(curr_row)
-
-            for j in range(0,len(data[i])):
-                heading = header[j]
-                              
-                if heading in self.amounts:
-                    name = data[i][j]
-                    amount = self.get_amount(data,i,j)
-                    tmp_result.set_field_complex(heading, {"name": name, "amount": amount})
-                    continue
-
-                if heading == 'mineral' and heading not in self.amounts:
-                    tmp_result.set_field_complex(heading, {"name": data[i][j]})
-                    continue
-
-                field = data[i][j]
-                if self.is_complex(heading):
-                    tmp_result.set_field_complex(heading,field)
-                else: tmp_result.set_field_simple(heading, field)
-            
-            tmp_result.set_field_simple('errors', errors)
-            result.append(tmp_result.get_rep())
+        # the rows are read lazily, but the parsed rows are kept: the
+        # response (or the job's result) echoes every one of them with its
+        # errors, so an upload is held in memory whole once parsed
+        result = list(self.parse_rows(rows))
+        if not result:
+            raise Exception("empty file")
         return result, meta_header
 
     def is_complex(self, name): return name in self.complex_types
@@ -154,8 +169,8 @@ class ChemicalAnalysesTemplate(Template):
             if header[i] in amounts and header[i+1] != 'amount':
                 raise Exception('missing {0} amount'.format(header[i]))
 
-    def get_amount(self,data=[], i=0,j=0):
-        return data[i][j+1]
+    def get_amount(self, row, j):
+        return row[j+1]
     
     def get_meta_header(self,header):
         mappings = {}
@@ -185,7 +200,7 @@ class SampleTemplate(Template):
     def check_amounts(self,header):
         pass
 
-    def get_amount(self,data=[],i=0,j=0):
+    def get_amount(self, row, j):
         return 0
     
     def get_meta_header(self,header):
@@ -1,6 +1,9 @@
 from django.contrib.auth.models import AnonymousUser
 from django.db.models import Q
 
+from api.lib.vocabulary import vocabulary
+from apps.chemical_analyses.models import Element, Oxide
+
 
 def chemical_analysis_query(user, params, qs):
     if isinstance(user, AnonymousUser):
@@ -18,40 +21,33 @@ def chemical_analysis_query(user, params, qs):
         qs = qs.filter(mineral__name__in=params['minerals'].split(','))
 
     if params.get('elements'):
-        elements = params['elements'].split(',')
-        if params.get('elements_and') == 'True':
-            for element in elements:
-                qs = qs.extra(where=["""
-                        EXISTS (
-                            SELECT 0
-                            FROM chemical_analysis_elements cae
-                            INNER JOIN elements e
-                            ON cae.element_id = e.id
-                            WHERE chemical_analyses.id = cae.chemical_analysis_id
-                            AND e.name = %s
-                        )
-                     """], params=[element])
-        else:
-            qs = qs.filter(elements__name__in=params['elements'].split(','))
+        qs = filter_by_ids(qs, 'element_ids',
+                           vocabulary(Element), 'name',
+                           params['elements'].split(','),
+                           params.get('elements_and') == 'True')
 
     if params.get('oxides'):
-        oxides = params['oxides'].split(',')
-        if params.get('oxides_and') == 'True':
-            for oxide in oxides:
-                qs = qs.extra(where=["""
-                        EXISTS (
-                            SELECT 0
-                            FROM chemical_analysis_oxides cao
-                            INNER JOIN oxides o
-                            ON cao.oxide_id = o.id
-                            WHERE chemical_analyses.id = cao.chemical_analysis_id
-                            AND o.species = %s
-                        )
-                     """], params=[oxide])
-        else:
-            qs = qs.filter(oxides__species__in=params['oxides'].split(','))
+        qs = filter_by_ids(qs, 'oxide_ids',
+                           vocabulary(Oxide), 'species',
+                           params['oxides'].split(','),
+                           params.get('oxides_and') == 'True')
 
     if params.get('subsample_ids'):
         qs = qs.filter(subsample_id__in=params.get('subsample_ids').split(','))
 
     return qs
+
+
+def filter_by_ids(qs, field, vocabulary, key, names, match_all):
+    """
+    Keeps the analyses whose id array `field` holds all (`match_all`) or
+    any of the vocabulary entries named `names`.
+    """
+    names = set(names)
+    ids = list(vocabulary.lookup(key, names).values())
+    if match_all:
+        if len(ids) < len(names):
+            # no analysis has an element or oxide that doesn't exist
+            return qs.none()
+        return qs.filter(**{field + '__contains': ids})
+    return qs.filter(**{field + '__overlap': ids})
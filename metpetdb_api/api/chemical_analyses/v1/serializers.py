@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
 from api.lib.serializers import DynamicFieldsModelSerializer
+from api.lib.vocabulary import vocabulary
 from api.samples.v1.serializers import MineralSerializer
 from api.users.v1.serializers import UserSerializer
 from apps.chemical_analyses.models import (
@@ -90,9 +91,8 @@ class ChemicalAnalysisSerializer(DynamicFieldsModelSerializer):
 
         if self.initial_data.get('mineral_id'):
             self._validated_data.update(
-                {'mineral': (Mineral
-                             .objects
-                             .get(pk=self.initial_data['mineral_id']))
+                {'mineral': (vocabulary(Mineral)
+                             .get(self.initial_data['mineral_id']))
                  })
 
         return not bool(self._errors)
@@ -1,4 +1,7 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from rest_framework import permissions, status, viewsets
+from rest_framework.decorators import list_route
 from rest_framework.response import Response
 
 from api.chemical_analyses.lib.query import chemical_analysis_query
@@ -8,11 +11,16 @@ from api.chemical_analyses.v1.serializers import (
     OxideSerializer,
 )
 
+from api.lib.batch import batch_ids, in_order
 from api.lib.permissions import IsOwnerOrReadOnly, IsSuperuserOrReadOnly
-from api.lib.query import sample_qs_optimizer, chemical_analyses_qs_optimizer
-from api.samples.lib.query import sample_query
-
-from apps.samples.models import Sample, Mineral, Subsample
+from api.lib.query import chemical_analyses_qs_optimizer
+from api.lib.search import analyses_of_samples
+from api.lib.vocabulary import vocabulary
+
+from apps.common.utils import sync_related_rows
+from apps.samples.models import Mineral, Subsample
+from apps.core.conditional import ConditionalGetMixin
+from apps.core.pagination import PaginationModeMixin
 from apps.chemical_analyses.models import (
     ChemicalAnalysis,
     ChemicalAnalysisElement,
@@ -21,12 +29,20 @@ from apps.chemical_analyses.models import (
     Oxide,
 )
 
+# the fields of an analysis' elements and oxides given with their ids
+AMOUNT_FIELDS = ('amount', 'precision', 'precision_type', 'measurement_unit',
+                 'min_amount', 'max_amount')
+
 
-class ChemicalAnalysisViewSet(viewsets.ModelViewSet):
+class ChemicalAnalysisViewSet(ConditionalGetMixin, PaginationModeMixin,
+                              viewsets.ModelViewSet):
     queryset = ChemicalAnalysis.objects.all()
     serializer_class = ChemicalAnalysisSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,
                           IsOwnerOrReadOnly,)
+    # the fields cursor pagination may order by
+    ordering_fields = ('pk', 'spot_id', 'analysis_date', 'analysis_method',
+                       'analyst', 'where_done', 'total')
 
     def get_serializer(self, *args, **kwargs):
         if self.request.method == 'PUT':
@@ -37,13 +53,8 @@ class ChemicalAnalysisViewSet(viewsets.ModelViewSet):
         params = request.query_params
 
         if params.get('sample_filters') == 'True':
-            sample_qs = Sample.objects.all()
-            sample_qs = sample_qs_optimizer(params, sample_qs)
-            sample_ids = sample_query(request.user,
-                                      params,
-                                      sample_qs).values_list('id')
-            qs = ChemicalAnalysis.objects.filter(
-                subsample__sample_id__in=sample_ids)
+            qs = analyses_of_samples(request.user, params,
+                                     self.get_queryset())
         else:
             qs = self.get_queryset().distinct()
             qs = chemical_analysis_query(request.user, params, qs)
@@ -51,84 +62,81 @@ class ChemicalAnalysisViewSet(viewsets.ModelViewSet):
         qs = chemical_analyses_qs_optimizer(params, qs)
 
         page = self.paginate_queryset(qs)
+        rows = page if page is not None else list(qs)
+        not_modified = self.check_etag(qs, rows, paginated=page is not None)
+        if not_modified is not None:
+            return not_modified
+
+        serializer = self.get_serializer(rows, many=True)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-
-        serializer = self.get_serializer(qs, many=True)
         return Response(serializer.data)
 
 
-    def _handle_elements(self, instance, params):
-        to_add = []
-        for record in params['elements']:
-            try:
-                to_add.append({
-                    'element': Element.objects.get(pk=record['id']),
-                    'amount': record['amount'],
-                    'precision': record['precision'],
-                    'precision_type': record['precision_type'],
-                    'measurement_unit': record['measurement_unit'],
-                    'min_amount': record['min_amount'],
-                    'max_amount': record['max_amount']
-                })
-            except Element.DoesNotExist:
-                return Response(
-                    data={'error': 'Invalid element id'},
-                    status=400)
-
-        (ChemicalAnalysisElement
-         .objects
-         .filter(chemical_analysis=instance)
-         .delete())
-
-        for record in to_add:
-            ChemicalAnalysisElement.objects.create(
-                chemical_analysis=instance,
-                element=record['element'],
-                amount=record['amount'],
-                precision=record['precision'],
-                precision_type=record['precision_type'],
-                measurement_unit=record['measurement_unit'],
-                min_amount=record['min_amount'],
-                max_amount=record['max_amount']
+    @list_route(methods=['post'], permission_classes=(permissions.AllowAny,))
+    def batch_get(self, request):
+        """
+        The chemical analyses whose ids are listed in the body
+        (`{"ids": [...]}`), those the user may see only, in the order given;
+        the `fields` and search parameters of the list apply.
+        """
+        params = request.query_params
+
+        try:
+            ids = batch_ids(request.data)
+        except ValueError as err:
+            return Response(
+                data={'error': err.args},
+                status=400
             )
 
+        qs = self.get_queryset().filter(pk__in=ids)
+        if params.get('sample_filters') == 'True':
+            qs = analyses_of_samples(request.user, params, qs)
+        else:
+            qs = chemical_analysis_query(request.user, params, qs)
 
-    def _handle_oxides(self, instance, params):
-        to_add = []
-        for record in params['oxides']:
-            try:
-                to_add.append({
-                    'oxide': Oxide.objects.get(pk=record['id']),
-                    'amount': record['amount'],
-                    'precision': record['precision'],
-                    'precision_type': record['precision_type'],
-                    'measurement_unit': record['measurement_unit'],
-                    'min_amount': record['min_amount'],
-                    'max_amount': record['max_amount']
-                })
-            except Oxide.DoesNotExist:
-                return Response(
-                    data={'error': 'Invalid oxide id'},
-                    status=400)
-
-        (ChemicalAnalysisOxide
-         .objects
-         .filter(chemical_analysis=instance)
-         .delete())
-
-        for record in to_add:
-            ChemicalAnalysisOxide.objects.create(
-                chemical_analysis=instance,
-                oxide=record['oxide'],
-                amount=record['amount'],
-                precision=record['precision'],
-                precision_type=record['precision_type'],
-                measurement_unit=record['measurement_unit'],
-                min_amount=record['min_amount'],
-                max_amount=record['max_amount']
-            )
+        qs = chemical_analyses_qs_optimizer(params, qs)
+        serializer = self.get_serializer(in_order(qs, ids), many=True)
+        return Response({'results': serializer.data})
+
+
+    def _amounts(self, model, records):
+        """
+        Maps the element or oxide ids of `records` to the values of their
+        amount fields, looking the ids up with a single query.
+        """
+        kind = model._meta.model_name
+        pks = vocabulary(model).lookup(
+            'pk', (record.get('id') for record in records))
+        amounts = {}
+        for record in records:
+            pk = pks.get(str(record.get('id')))
+            if pk is None:
+                raise ValueError('Invalid {} id'.format(kind))
+            values = {}
+            for name in AMOUNT_FIELDS:
+                field = ChemicalAnalysisElement._meta.get_field(name)
+                try:
+                    values[name] = field.to_python(record[name])
+                except ValidationError:
+                    raise ValueError('Invalid {} {}'.format(kind, name))
+            amounts[pk] = values
+        return amounts
+
+
+    def _handle_elements(self, instance, amounts):
+        sync_related_rows(ChemicalAnalysisElement,
+                          'chemical_analysis_id', 'element_id',
+                          {instance.pk: amounts})
+        instance.element_ids = sorted(amounts)
+
+
+    def _handle_oxides(self, instance, amounts):
+        sync_related_rows(ChemicalAnalysisOxide,
+                          'chemical_analysis_id', 'oxide_id',
+                          {instance.pk: amounts})
+        instance.oxide_ids = sorted(amounts)
 
 
     def perform_create(self, serializer):
@@ -138,41 +146,23 @@ class ChemicalAnalysisViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        instance = self.perform_create(serializer)
 
-        if request.data.get('elements'):
-            for record in request.data.get('elements'):
-                try:
-                    ChemicalAnalysisElement.objects.create(
-                        chemical_analysis=instance,
-                        element=Element.objects.get(pk=record['id']),
-                        amount=record['amount'],
-                        precision=record['precision'],
-                        precision_type=record['precision_type'],
-                        measurement_unit=record['measurement_unit'],
-                        min_amount=record['min_amount'],
-                        max_amount=record['max_amount'],
-                    )
-                except Element.DoesNotExist:
-                    return Response(data={'error': 'Invalid element id'},
-                                    status=400)
-
-        if request.data.get('oxides'):
-            for record in request.data.get('oxides'):
-                try:
-                    ChemicalAnalysisOxide.objects.create(
-                        chemical_analysis=instance,
-                        oxide=Oxide.objects.get(pk=record['id']),
-                        amount=record['amount'],
-                        precision=record['precision'],
-                        precision_type=record['precision_type'],
-                        measurement_unit=record['measurement_unit'],
-                        min_amount=record['min_amount'],
-                        max_amount=record['max_amount'],
-                    )
-                except Oxide.DoesNotExist:
-                    return Response(data={'error': 'Invalid oxide id'},
-                                    status=400)
+        try:
+            elements = self._amounts(Element,
+                                     request.data.get('elements') or [])
+            oxides = self._amounts(Oxide, request.data.get('oxides') or [])
+        except ValueError as err:
+            return Response(data={'error': err.args}, status=400)
+
+        with transaction.atomic():
+            instance = self.perform_create(serializer)
+            self._handle_elements(instance, elements)
+            self._handle_oxides(instance, oxides)
+            (ChemicalAnalysis
+             .objects
+             .filter(pk=instance.pk)
+             .update(element_ids=instance.element_ids,
+                     oxide_ids=instance.oxide_ids))
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data,
@@ -188,33 +178,47 @@ class ChemicalAnalysisViewSet(viewsets.ModelViewSet):
                                          data=request.data,
                                          partial=partial)
         serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
 
+        # everything is validated before anything is written
         if 'mineral_id' in params:
             try:
-                mineral = Mineral.objects.get(pk=params['mineral_id'])
+                mineral = vocabulary(Mineral).get(params['mineral_id'])
             except Mineral.DoesNotExist:
                 return Response(data={'error': 'Invalid mineral id'},
                                 status=400)
-            else:
-                instance.mineral = mineral
 
         if 'subsample_id' in params:
             try:
                 subsample = Subsample.objects.get(pk=params['subsample_id'])
-            except Mineral.DoesNotExist:
+            except (Subsample.DoesNotExist, ValueError):
                 return Response(data={'error': 'Invalid subsample id'},
                                 status=400)
-            else:
+
+        try:
+            if 'elements' in params:
+                elements = self._amounts(Element, params['elements'] or [])
+            if 'oxides' in params:
+                oxides = self._amounts(Oxide, params['oxides'] or [])
+        except ValueError as err:
+            return Response(data={'error': err.args}, status=400)
+
+        with transaction.atomic():
+            self.perform_update(serializer)
+
+            if 'mineral_id' in params:
+                instance.mineral = mineral
+
+            if 'subsample_id' in params:
                 instance.subsample = subsample
 
-        if 'elements' in params:
-            self._handle_elements(instance, params)
+            if 'elements' in params:
+                self._handle_elements(instance, elements)
+
+            if 'oxides' in params:
+                self._handle_oxides(instance, oxides)
 
-        if 'oxides' in params:
-            self._handle_oxides(instance, params)
+            instance.save()
 
-        instance.save()
         # refresh the data before returning a response
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
@@ -0,0 +1,35 @@
+import uuid
+
+# largest number of objects a batch request may name
+BATCH_MAX_SIZE = 500
+
+
+def batch_ids(data):
+    """
+    Returns the ids listed under `ids` in the body of a batch request, as
+    UUIDs without duplicates, in their original order; raises ValueError
+    if they are missing, invalid or too many.
+    """
+    ids = data.get('ids') if hasattr(data, 'get') else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError('ids must be a non-empty list')
+    if len(ids) > BATCH_MAX_SIZE:
+        raise ValueError('At most {} ids may be given'.format(BATCH_MAX_SIZE))
+
+    parsed = []
+    for id in ids:
+        try:
+            id = uuid.UUID(str(id))
+        except ValueError:
+            raise ValueError('Invalid id: {}'.format(id))
+        if id not in parsed:
+            parsed.append(id)
+    return parsed
+
+
+def in_order(objects, ids):
+    """
+    Returns `objects` sorted like their primary keys in `ids`.
+    """
+    by_pk = {obj.pk: obj for obj in objects}
+    return [by_pk[id] for id in ids if id in by_pk]
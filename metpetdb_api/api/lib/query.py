@@ -1,39 +1,137 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+
+from api.users.v1.serializers import UserSerializer
+from apps.samples.models import MetamorphicRegion, Sample
+from apps.users.models import User
+
+# SampleSerializer fields computed from other columns
+SAMPLE_COMPUTED_COLUMNS = {
+    'latitude': ('location_coords',),
+    'longitude': ('location_coords',),
+}
+
+# the columns of a user serialized by UserSerializer
+USER_COLUMNS = tuple(name for name in UserSerializer.Meta.fields
+                     if name != 'id')
+
+
+def requested_fields(params):
+    """
+    Returns the set of fields asked for by the `fields` query parameter, or
+    None if every field is.
+    """
+    fields = params.get('fields')
+    if not fields:
+        return None
+    return set(fields.split(','))
+
+
+def model_columns(model, fields, computed=None):
+    """
+    Returns the columns of `model` needed to serialize `fields`: those of
+    its concrete fields (foreign keys included) and those named by
+    `computed` for fields computed from other columns.
+    """
+    columns = set()
+    for name in fields:
+        if computed and name in computed:
+            columns.update(computed[name])
+            continue
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if field.concrete and not field.many_to_many:
+            columns.add(name)
+    return columns
+
+
+def sample_prefetches(fields):
+    """
+    Returns the prefetch_related lookups needed to serialize `fields` of
+    samples (all of them if `fields` is None). Related rows are loaded
+    with the columns the serializer shows only.
+    """
+    lookups = []
+    if fields is None or 'owner' in fields:
+        owners = User.objects.only('name')
+        lookups.append(Prefetch('owner', queryset=owners))
+    if fields is None or 'metamorphic_grades' in fields:
+        lookups.append('metamorphic_grades')
+    if fields is None or 'metamorphic_regions' in fields:
+        # leaves the region shapes out
+        regions = MetamorphicRegion.objects.only('name')
+        lookups.append(Prefetch('metamorphic_regions', queryset=regions))
+    if fields is None or 'minerals' in fields:
+        lookups.append('samplemineral_set__mineral')
+    if fields is None or 'references' in fields:
+        lookups.append('references')
+    return lookups
+
+
 def sample_qs_optimizer(params, qs):
-    try:
-        fields = params.get('fields').split(',')
-        if 'rock_types' in fields:
-            qs = qs.select_related('rock_type')
-        if 'metamorphic_grades' in fields:
-            qs = qs.prefetch_related('metamorphic_grades')
-        if 'metamorphic_regions' in fields:
-            qs = qs.prefetch_related('metamorphic_regions')
-        if 'minerals' in fields:
-            qs = qs.prefetch_related('samplemineral_set__mineral')
-        if 'owner' in fields:
-            qs = qs.prefetch_related('owner')
-    except AttributeError:
+    """
+    Loads the columns and related rows needed to serialize the fields
+    asked for by `params`, and nothing else.
+    """
+    fields = requested_fields(params)
+    if fields is None:
+        qs = qs.select_related('rock_type')
+        return qs.prefetch_related(*sample_prefetches(None))
+
+    columns = model_columns(qs.model, fields, SAMPLE_COMPUTED_COLUMNS)
+    qs = qs.only('pk', *columns)
+    if 'rock_type' in fields:
         qs = qs.select_related('rock_type')
-        qs = qs.prefetch_related('metamorphic_grades',
-                                 'metamorphic_regions',
-                                 'samplemineral_set__mineral',
-                                 'owner')
+    return qs.prefetch_related(*sample_prefetches(fields))
+
+
+def subsample_qs_optimizer(params, qs):
+    """
+    Loads the columns and related rows needed to serialize the fields
+    asked for by `params`; the nested samples and users are loaded the
+    same way.
+    """
+    fields = requested_fields(params)
+
+    if fields is not None:
+        qs = qs.only('pk', *model_columns(qs.model, fields))
+
+    if fields is None or 'owner' in fields:
+        qs = qs.prefetch_related(
+            Prefetch('owner', queryset=User.objects.only(*USER_COLUMNS)))
+    if fields is None or 'subsample_type' in fields:
+        qs = qs.select_related('subsample_type')
+    if fields is None or 'sample' in fields:
+        # the nested samples show the same `fields`
+        samples = sample_qs_optimizer(params, Sample.objects.all())
+        qs = qs.prefetch_related(Prefetch('sample', queryset=samples))
     return qs
 
 
 def chemical_analyses_qs_optimizer(params, qs):
-    try:
-        fields = params.get('fields').split(',')
-
-        for field in ('mineral', 'owner', 'subsample'):
-            if field in fields:
-                qs = qs.select_related(field)
-
-        if 'elements' in fields:
-            qs = qs.prefetch_related('chemicalanalysiselement_set__element')
-        if 'oxides' in fields:
-            qs = qs.prefetch_related('chemicalanalysisoxide_set__oxide')
-    except AttributeError:
+    """
+    Loads the columns and related rows needed to serialize the fields
+    asked for by `params`, and nothing else.
+    """
+    fields = requested_fields(params)
+    if fields is None:
         qs = qs.select_related('mineral', 'owner', 'subsample')
-        qs = qs.prefetch_related('chemicalanalysiselement_set__element',
-                                 'chemicalanalysisoxide_set__oxide')
+        return qs.prefetch_related('chemicalanalysiselement_set__element',
+                                   'chemicalanalysisoxide_set__oxide')
+
+    columns = model_columns(qs.model, fields)
+    if 'owner' in fields:
+        columns.update('owner__' + name for name in USER_COLUMNS)
+    qs = qs.only('pk', *columns)
+
+    for field in ('mineral', 'owner', 'subsample'):
+        if field in fields:
+            qs = qs.select_related(field)
+
+    if 'elements' in fields:
+        qs = qs.prefetch_related('chemicalanalysiselement_set__element')
+    if 'oxides' in fields:
+        qs = qs.prefetch_related('chemicalanalysisoxide_set__oxide')
     return qs
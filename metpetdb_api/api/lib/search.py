@@ -0,0 +1,96 @@
+"""
+Searches across samples and chemical analyses
+
+A sample search with `chemical_analyses_filters=True` keeps the samples
+that have at least one matching chemical analysis, and an analysis search
+with `sample_filters=True` keeps the analyses of matching samples. Either
+way the query parameters are split between the two sides (see
+split_params) and both are filtered in a single query, the other side
+being tested with an EXISTS semi-join, which neither multiplies the rows
+nor needs them made distinct again.
+"""
+from django.http import QueryDict
+
+from api.chemical_analyses.lib.query import chemical_analysis_query
+from api.samples.lib.query import sample_query
+from apps.chemical_analyses.models import ChemicalAnalysis
+from apps.common.utils import compiled_sql
+from apps.samples.models import Sample
+
+# the parameters chemical_analysis_query understands; the others are
+# sample_query's
+CHEMICAL_ANALYSIS_PARAMS = {'elements', 'elements_and', 'oxides',
+                            'oxides_and', 'subsample_ids', 'minerals',
+                            'provenance'}
+
+# the parameters both understand, which go to the side being filtered on
+SHARED_PARAMS = {'minerals'}
+
+# the parameters that apply to both sides: `provenance=Public` has to keep
+# the private rows of either side out, as the searches limited to public
+# data are cached for everyone
+BOTH_SIDES_PARAMS = {'provenance'}
+
+
+def split_params(params, shared_with_analyses):
+    """
+    Splits `params` into the sample and the chemical analysis parameters;
+    the ones both sides understand go to the analyses if
+    `shared_with_analyses`, and to the samples otherwise, but for those of
+    BOTH_SIDES_PARAMS which go to both.
+    """
+    sample_params = QueryDict(mutable=True)
+    analysis_params = QueryDict(mutable=True)
+    for name in params:
+        if name in BOTH_SIDES_PARAMS:
+            targets = (sample_params, analysis_params)
+        elif name in SHARED_PARAMS:
+            targets = ((analysis_params,) if shared_with_analyses
+                       else (sample_params,))
+        elif name in CHEMICAL_ANALYSIS_PARAMS:
+            targets = (analysis_params,)
+        else:
+            targets = (sample_params,)
+        for target in targets:
+            target.setlist(name, params.getlist(name))
+    return sample_params, analysis_params
+
+
+def semi_join(qs, other, other_key, column):
+    """
+    Keeps the rows of `qs` whose `column` matches the `other_key` of some
+    row of `other`, with an EXISTS semi-join.
+    """
+    compiled = compiled_sql(other.order_by().values(other_key))
+    if compiled is None:
+        # Django knows `other` has no row (e.g. it's a none())
+        return qs.none()
+    sql, params = compiled
+    return qs.extra(
+        where=['EXISTS (SELECT 1 FROM ({}) AS semi_join (key) '
+               'WHERE semi_join.key = "{}"."{}")'
+               .format(sql, qs.model._meta.db_table, column)],
+        params=params)
+
+
+def samples_with_analyses(user, params, qs):
+    """
+    Returns the samples of `qs` matching the sample parameters of `params`
+    with at least one chemical analysis matching its analysis parameters.
+    """
+    sample_params, analysis_params = split_params(params, True)
+    qs = sample_query(user, sample_params, qs)
+    analyses = chemical_analysis_query(user, analysis_params,
+                                       ChemicalAnalysis.objects.all())
+    return semi_join(qs, analyses, 'subsample__sample_id', 'id')
+
+
+def analyses_of_samples(user, params, qs):
+    """
+    Returns the chemical analyses of `qs` matching the analysis parameters
+    of `params` whose sample matches its sample parameters.
+    """
+    sample_params, analysis_params = split_params(params, False)
+    qs = chemical_analysis_query(user, analysis_params, qs)
+    samples = sample_query(user, sample_params, Sample.objects.all())
+    return semi_join(qs, samples, 'subsamples__id', 'subsample_id')
@@ -0,0 +1,159 @@
+"""
+Process-local cache of the reference vocabularies
+
+Elements, oxides, minerals, rock types, metamorphic grades and metamorphic
+regions are small tables that hardly ever change, so each process loads
+them once and resolves names and ids from memory afterwards:
+
+    vocabulary(Mineral).get(pk)                 # like Mineral.objects.get
+    vocabulary(Mineral).lookup('name', names)   # {name: pk} of known names
+
+A process drops its copy of a vocabulary whenever it saves or deletes one
+of its rows (post_save/post_delete). Other processes learn about the change
+from the version stamps in the vocabulary_versions table, which triggers
+bump on any write to the vocabulary tables (bulk inserts and raw SQL
+included). The stamp of a vocabulary is read at most once per request, or
+once every VOCABULARY_VERSION_TTL seconds outside of requests; set
+VOCABULARY_VERSION_CHECK to False to skip that check in single-process
+deployments.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+from apps.chemical_analyses.models import Element, Oxide
+from apps.samples.models import (
+    MetamorphicGrade,
+    MetamorphicRegion,
+    Mineral,
+    RockType,
+)
+
+
+def version_check_enabled():
+    return getattr(settings, 'VOCABULARY_VERSION_CHECK', True)
+
+
+def version_ttl():
+    return getattr(settings, 'VOCABULARY_VERSION_TTL', 5)
+
+
+def read_version(table):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT version FROM vocabulary_versions WHERE name = %s',
+            [table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class Vocabulary:
+    def __init__(self, model, key='name', defer=()):
+        self.model = model
+        self.key = key
+        self.defer = defer
+        self.table = model._meta.db_table
+        # (version, {str(pk): object}, {key: pk}), swapped as a whole
+        self.state = None
+        # when the version stamp was last read (time.monotonic())
+        self.checked = None
+
+    def load(self, version):
+        objects = {}
+        pks = {}
+        for obj in self.model.objects.defer(*self.defer):
+            objects[str(obj.pk)] = obj
+            key = getattr(obj, self.key)
+            if key is not None:
+                pks[key] = obj.pk
+        self.state = (version, objects, pks)
+        return self.state
+
+    def invalidate(self):
+        self.state = None
+
+    def expire(self):
+        self.checked = None
+
+    def current(self):
+        state = self.state
+        if version_check_enabled():
+            now = time.monotonic()
+            if (state is None or self.checked is None or
+                    now - self.checked > version_ttl()):
+                version = read_version(self.table)
+                self.checked = now
+                if state is None or state[0] != version:
+                    state = self.load(version)
+        elif state is None:
+            state = self.load(None)
+        return state
+
+    def get(self, pk):
+        """
+        Returns the row with primary key `pk`; raises DoesNotExist, like
+        `model.objects.get(pk=pk)`, if there is none.
+        """
+        _, objects, _ = self.current()
+        try:
+            return objects[str(uuid.UUID(str(pk)))]
+        except (KeyError, ValueError):
+            raise self.model.DoesNotExist(
+                '{} matching query does not exist.'
+                .format(self.model._meta.object_name))
+
+    def lookup(self, field, values):
+        """
+        Maps each of `values` that exists in `field` (either 'pk' or the
+        vocabulary's key) to the pk of its row.
+        """
+        _, objects, pks = self.current()
+        values = set(str(v) for v in values if v != '')
+        if field == 'pk':
+            found = {}
+            for value in values:
+                try:
+                    obj = objects.get(str(uuid.UUID(value)))
+                except ValueError:
+                    continue
+                if obj is not None:
+                    found[value] = obj.pk
+            return found
+        return {value: pks[value] for value in values if value in pks}
+
+
+VOCABULARIES = {
+    Element: Vocabulary(Element),
+    Oxide: Vocabulary(Oxide, key='species'),
+    Mineral: Vocabulary(Mineral),
+    RockType: Vocabulary(RockType),
+    MetamorphicGrade: Vocabulary(MetamorphicGrade),
+    MetamorphicRegion: Vocabulary(MetamorphicRegion,
+                                  defer=('shape', 'shape_low', 'shape_medium',
+                                         'shape_high')),
+}
+
+
+def vocabulary(model):
+    return VOCABULARIES[model]
+
+
+def invalidate_vocabulary(sender, **kwargs):
+    VOCABULARIES[sender].invalidate()
+
+
+for model in VOCABULARIES:
+    post_save.connect(invalidate_vocabulary, sender=model)
+    post_delete.connect(invalidate_vocabulary, sender=model)
+
+
+def expire_vocabularies(sender, **kwargs):
+    for cache in VOCABULARIES.values():
+        cache.expire()
+
+
+request_started.connect(expire_vocabularies)
@@ -0,0 +1,31 @@
+from multiprocessing import Process
+
+from django.core.management import BaseCommand
+
+from api.bulk_upload.v1.jobs import POLL_INTERVAL, work
+
+
+class Command(BaseCommand):
+    help = 'Runs a pool of worker processes for queued bulk uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2,
+                            help='Number of worker processes')
+        parser.add_argument('--poll-interval', type=float,
+                            default=POLL_INTERVAL,
+                            help='Seconds between polls of an empty queue')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        workers = [Process(target=work,
+                           args=(options['poll_interval'], options['once']))
+                   for i in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
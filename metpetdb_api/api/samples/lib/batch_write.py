@@ -0,0 +1,290 @@
+"""
+Batch creation and update of samples
+
+SampleBatchWriter takes a list of sample payloads shaped like the bodies
+of SampleViewSet.create, or of SampleViewSet.update when they carry the
+`id` of an existing sample. Within a single transaction, it validates
+all of them in memory, against vocabularies and samples resolved with one
+query each (the edited samples are locked until the transaction ends, so
+that concurrent edits are neither overwritten nor lost). It then writes
+them: new samples with bulk_create, edited ones with bulk_update (only
+the fields their payloads give), and their minerals, metamorphic regions,
+metamorphic grades and references with batched statements. Either every
+payload is written or none is.
+"""
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+
+from api.bulk_upload.v1.processing import (
+    BATCH_SIZE,
+    BulkUploadProcessor,
+    normalize_uuid,
+)
+from api.lib.batch import BATCH_MAX_SIZE
+from api.lib.vocabulary import vocabulary
+from api.samples.lib import search_cache
+from api.samples.lib.references import georeference_ids
+from api.samples.v1.serializers import SAMPLE_FIELDS
+from apps.common.utils import bulk_update, sync_related_rows
+from apps.samples.models import (
+    MetamorphicGrade,
+    MetamorphicRegion,
+    Mineral,
+    RockType,
+    Sample,
+    SampleMineral,
+)
+from apps.samples.regions import assign_metamorphic_regions
+
+
+def update_fields(payload):
+    """
+    Returns the columns written back to a sample edited by `payload`: the
+    ones it gives, and the version.
+    """
+    fields = [name for name in SAMPLE_FIELDS if name in payload]
+    if 'rock_type_id' in payload:
+        fields.append('rock_type')
+    if 'minerals' in payload:
+        fields.append('mineral_ids')
+    return tuple(fields) + ('version',)
+
+
+class SampleBatchWriter:
+    def __init__(self, user):
+        self.user = user
+        self.processor = BulkUploadProcessor(user.pk, None)
+
+    def write(self, payloads):
+        """
+        Validates and writes `payloads`; returns one result per payload,
+        with its `id`, `status` and `errors`, and whether all of them were
+        written. The status is `created` or `updated` once written, and
+        `invalid` or `valid` (but not written) otherwise. Problems with the
+        batch as a whole are raised as ValueError.
+        """
+        if not isinstance(payloads, list) or not payloads:
+            raise ValueError('Expected a non-empty list of samples')
+        if len(payloads) > BATCH_MAX_SIZE:
+            raise ValueError('At most {} samples may be written at a time'
+                             .format(BATCH_MAX_SIZE))
+        if not all(isinstance(payload, dict) for payload in payloads):
+            raise ValueError('Every sample must be an object')
+
+        try:
+            with transaction.atomic():
+                self.resolve(payloads)
+                results, created, updated = self.build_all(payloads)
+                if any(result['errors'] for result in results):
+                    return results, False
+
+                Sample.objects.bulk_create(created, batch_size=BATCH_SIZE)
+                # bulk_update sets the same fields on every row of a call
+                by_fields = {}
+                for sample, payload in updated:
+                    by_fields.setdefault(update_fields(payload), []).append(
+                        sample)
+                for fields, samples in by_fields.items():
+                    bulk_update(samples, fields, batch_size=BATCH_SIZE)
+                self.write_related()
+                assign_metamorphic_regions(
+                    sample_ids=[sample.pk for sample in created] +
+                               [sample.pk for sample, _ in updated])
+        except DatabaseError as err:
+            raise ValueError(str(err))
+
+        # bulk writes send no signals
+        search_cache.invalidate_sample_search(self)
+
+        for payload, result in zip(payloads, results):
+            result['status'] = 'updated' if payload.get('id') else 'created'
+        return results, True
+
+    def build_all(self, payloads):
+        """
+        Builds the samples described by `payloads`; returns one result per
+        payload, the new samples, and the edited ones along with their
+        payloads.
+        """
+        results = []
+        created = []
+        updated = []
+        seen = set()
+        for payload in payloads:
+            errors = {}
+            sample = self.build(payload, errors)
+            if payload.get('id') and sample is not None:
+                if sample.pk in seen:
+                    errors['id'] = 'Duplicate sample id: {}'.format(sample.pk)
+                seen.add(sample.pk)
+            if sample is not None and not errors:
+                if payload.get('id'):
+                    updated.append((sample, payload))
+                else:
+                    created.append(sample)
+            results.append({
+                'id': str(sample.pk) if sample is not None else None,
+                'status': 'invalid' if errors else 'valid',
+                'errors': errors,
+            })
+        return results, created, updated
+
+    def resolve(self, payloads):
+        """
+        Looks up everything the payloads refer to, with one query per kind
+        of object at most. The edited samples are locked (SELECT ... FOR
+        UPDATE), so this must run inside a transaction.
+        """
+        def values(key):
+            for payload in payloads:
+                value = payload.get(key)
+                if isinstance(value, list):
+                    for item in value:
+                        yield item
+
+        def ids(values):
+            return (id for id in (normalize_uuid(value) for value in values)
+                    if id)
+
+        sample_ids = list(ids(payload['id'] for payload in payloads
+                              if payload.get('id')))
+        self.samples = {
+            str(sample.pk): sample
+            for sample in (Sample.objects
+                           .select_for_update()
+                           .filter(pk__in=sample_ids)
+                           .order_by('pk'))
+        }
+        self.rock_types = vocabulary(RockType).lookup(
+            'pk', ids(payload.get('rock_type_id') for payload in payloads))
+        self.metamorphic_regions = vocabulary(MetamorphicRegion).lookup(
+            'pk', ids(values('metamorphic_region_ids')))
+        self.metamorphic_grades = vocabulary(MetamorphicGrade).lookup(
+            'pk', ids(values('metamorphic_grade_ids')))
+        self.minerals = vocabulary(Mineral).lookup(
+            'pk', ids(mineral.get('id') for mineral in values('minerals')
+                      if isinstance(mineral, dict)))
+
+        # the related rows to write, by sample id
+        self.sample_regions = {}
+        self.sample_grades = {}
+        self.sample_minerals = {}
+        self.sample_references = {}
+
+    def may_edit(self, sample):
+        return self.user.is_superuser or sample.owner_id == self.user.pk
+
+    def build(self, payload, errors):
+        """
+        Returns the new or edited sample described by `payload`, recording
+        its related rows for write_related and any problems in `errors`.
+        """
+        rock_type_id = None
+        if 'rock_type_id' in payload or not payload.get('id'):
+            rock_type_id = self.rock_types.get(
+                normalize_uuid(payload.get('rock_type_id')))
+            if rock_type_id is None:
+                errors['rock_type_id'] = 'Invalid rock_type id'
+
+        if payload.get('id'):
+            sample = self.samples.get(normalize_uuid(payload['id']))
+            if sample is None:
+                errors['id'] = 'Invalid sample id: {}'.format(payload['id'])
+                return None
+            if not self.may_edit(sample):
+                errors['id'] = ('You do not have permission to edit sample {}'
+                                .format(payload['id']))
+                return sample
+            try:
+                self.update_sample(sample, payload)
+            except ValidationError as err:
+                errors['serialization'] = str(err)
+            if rock_type_id is not None:
+                sample.rock_type_id = rock_type_id
+            sample.version += 1
+        else:
+            try:
+                sample = self.processor.build(Sample, SAMPLE_FIELDS, payload,
+                                              owner_id=self.user.pk,
+                                              rock_type_id=rock_type_id)
+            except ValidationError as err:
+                errors['serialization'] = str(err)
+                return None
+
+        if 'metamorphic_region_ids' in payload:
+            self.sample_regions[sample.pk] = self.resolve_ids(
+                payload['metamorphic_region_ids'], self.metamorphic_regions,
+                'metamorphic_region', errors)
+
+        if 'metamorphic_grade_ids' in payload:
+            self.sample_grades[sample.pk] = self.resolve_ids(
+                payload['metamorphic_grade_ids'], self.metamorphic_grades,
+                'metamorphic_grade', errors)
+
+        if 'minerals' in payload:
+            amounts = {}
+            for record in payload['minerals'] or []:
+                if not isinstance(record, dict):
+                    record = {}
+                mineral_id = self.minerals.get(
+                    normalize_uuid(record.get('id')))
+                if mineral_id is None:
+                    errors['minerals'] = ('Invalid mineral id: {}'
+                                          .format(record.get('id')))
+                    continue
+                amounts[mineral_id] = {'amount': record.get('amount')}
+            self.sample_minerals[sample.pk] = amounts
+            sample.mineral_ids = sorted(amounts)
+
+        if 'references' in payload:
+            self.sample_references[sample.pk] = set(
+                name for name in payload['references'] or [] if name)
+
+        return sample
+
+    def update_sample(self, sample, payload):
+        # like SampleSerializer.update
+        for name in SAMPLE_FIELDS:
+            if name in payload:
+                field = Sample._meta.get_field(name)
+                setattr(sample, field.attname,
+                        self.processor.clean_value(field, payload[name]))
+        sample.clean_fields(
+            exclude=[f.name for f in Sample._meta.fields
+                     if f.primary_key or f.is_relation or f.name == 'version']
+        )
+
+    def resolve_ids(self, values, ids, kind, errors):
+        resolved = set()
+        for value in values or []:
+            id = ids.get(normalize_uuid(value))
+            if id is None:
+                errors[kind + '_ids'] = 'Invalid {} id: {}'.format(kind, value)
+            else:
+                resolved.add(id)
+        return resolved
+
+    def write_related(self):
+        """
+        Brings the related rows of the samples whose payloads gave them in
+        line with the payloads, touching only the rows that changed.
+        """
+        sync_related_rows(Sample.metamorphic_regions.through,
+                          'sample_id', 'metamorphicregion_id',
+                          self.sample_regions, batch_size=BATCH_SIZE)
+        sync_related_rows(Sample.metamorphic_grades.through,
+                          'sample_id', 'metamorphicgrade_id',
+                          self.sample_grades, batch_size=BATCH_SIZE)
+        sync_related_rows(SampleMineral, 'sample_id', 'mineral_id',
+                          self.sample_minerals, batch_size=BATCH_SIZE)
+
+        georeferences = georeference_ids(
+            name for names in self.sample_references.values()
+            for name in names)
+        sync_related_rows(Sample.references.through,
+                          'sample_id', 'georeference_id',
+                          {sample_id: set(georeferences[name]
+                                          for name in names)
+                           for sample_id, names
+                           in self.sample_references.items()},
+                          batch_size=BATCH_SIZE)
@@ -1,9 +1,49 @@
 import json
+from functools import lru_cache
 
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.gis.geos import Polygon, GEOSException
+from django.db import connections
 from django.db.models import Q, F
 
+from api.lib.vocabulary import vocabulary
+from apps.common.utils import compiled_sql
+from apps.samples.models import Mineral
+
+CLUSTERINGS = ('grid', 'geohash')
+MAX_CLUSTER_ZOOM = 20
+
+# samples are clustered in cells about this many pixels wide on a map made
+# of 256 pixel tiles
+CLUSTER_CELL_PIXELS = 64
+
+
+@lru_cache(maxsize=256)
+def polygon_rings(coords):
+    """
+    Returns the rings of the polygon described by the JSON `coords`, as
+    tuples of coordinates. Polygons are parsed and validated once, then
+    reused by repeated searches.
+    """
+    try:
+        polygon = Polygon((json.loads(coords)))
+    except GEOSException:
+        raise ValueError("Invalid polygon coordinates. Please check if "
+                         "the points form a closed linestring or not.")
+    if not polygon.valid:
+        raise ValueError("Invalid polygon coordinates: {}"
+                         .format(polygon.valid_reason))
+    return polygon.coords
+
+
+def parse_polygon(coords):
+    """
+    Returns the polygon described by the JSON `coords`; raises ValueError
+    if it isn't a valid one. GEOS geometries are mutable, so every caller
+    gets a polygon of its own.
+    """
+    return Polygon(*polygon_rings(coords))
+
 
 def sample_query(user, params, qs):
     
@@ -36,12 +76,13 @@ def sample_query(user, params, qs):
         qs = qs.filter(location_coords__contained=bbox)
 
     if params.get('polygon_coords'):
-        try:
-            polygon = Polygon((json.loads(params['polygon_coords'])))
-        except GEOSException:
-            raise ValueError("Invalid polygon coordinates. Please check if "
-                             "the points form a closed linestring or not.")
+        polygon = parse_polygon(params['polygon_coords'])
+        # the bounding box comparison (@) is answered by the GiST index on
+        # location_coords; with polygon_within, ST_Within then checks the
+        # remaining samples against the polygon itself
         qs = qs.filter(location_coords__contained=polygon)
+        if params.get('polygon_within') == 'True':
+            qs = qs.filter(location_coords__within=polygon)
 
     if params.get('metamorphic_grades'):
         metamorphic_grades = params['metamorphic_grades'].split(',')
@@ -52,21 +93,17 @@ def sample_query(user, params, qs):
         qs =qs.filter(metamorphic_regions__name__in=metamorphic_regions)
 
     if params.get('minerals'):
-        minerals = params['minerals'].split(',')
+        minerals = set(params['minerals'].split(','))
+        mineral_ids = list(vocabulary(Mineral).lookup('name', minerals)
+                           .values())
         if params.get('minerals_and') == 'True':
-            for mineral in minerals:
-                qs = qs.extra(where=["""
-                        EXISTS (
-                            SELECT 0
-                            FROM sample_minerals sm
-                            INNER JOIN minerals m
-                            ON sm.mineral_id = m.id
-                            WHERE samples.id = sm.sample_id
-                            AND m.name = %s
-                        )
-                     """], params=[mineral])
+            if len(mineral_ids) < len(minerals):
+                # no sample has a mineral that doesn't exist
+                qs = qs.none()
+            else:
+                qs = qs.filter(mineral_ids__contains=mineral_ids)
         else:
-            qs = qs.filter(minerals__name__in=minerals)
+            qs = qs.filter(mineral_ids__overlap=mineral_ids)
 
     if params.get('owners'):
         qs = qs.filter(owner__name__in=params['owners'].split(','))
@@ -96,3 +133,108 @@ def sample_query(user, params, qs):
         qs = qs.order_by(params['ordering'])
 
     return qs
+
+
+def sample_csv_columns(qs):
+    """
+    Works out the dynamic columns of a CSV export of `qs` in a single
+    aggregate query: the mineral names used by any of the samples, and the
+    largest number of regions (incl. metamorphic regions), references and
+    metamorphic grades attached to a single sample.
+    """
+    compiled = compiled_sql(qs.order_by().values('pk'))
+    if compiled is None:
+        return {'minerals': [], 'num_regions': 0, 'num_refs': 0,
+                'num_grades': 0}
+    ids_sql, params = compiled
+
+    with connections[qs.db].cursor() as cursor:
+        cursor.execute("""
+            WITH s AS ({})
+            SELECT
+                (SELECT array_agg(DISTINCT m.name)
+                 FROM sample_minerals sm
+                 INNER JOIN minerals m
+                 ON sm.mineral_id = m.id
+                 WHERE sm.sample_id IN (SELECT id FROM s)),
+                (SELECT max(n) FROM (
+                    SELECT count(DISTINCT initcap(r.name)) n
+                    FROM (
+                        SELECT samples.id sample_id, unnest(regions) AS name
+                        FROM samples
+                        WHERE samples.id IN (SELECT id FROM s)
+                        UNION ALL
+                        SELECT smr.sample_id, mr.name
+                        FROM samples_metamorphic_regions smr
+                        INNER JOIN metamorphic_regions mr
+                        ON smr.metamorphicregion_id = mr.id
+                        WHERE smr.sample_id IN (SELECT id FROM s)
+                    ) r
+                    GROUP BY r.sample_id) t),
+                (SELECT max(n) FROM (
+                    SELECT count(DISTINCT sr.georeference_id) n
+                    FROM samples_references sr
+                    WHERE sr.sample_id IN (SELECT id FROM s)
+                    GROUP BY sr.sample_id) t),
+                (SELECT max(n) FROM (
+                    SELECT count(DISTINCT initcap(mg.name)) n
+                    FROM samples_metamorphic_grades smg
+                    INNER JOIN metamorphic_grades mg
+                    ON smg.metamorphicgrade_id = mg.id
+                    WHERE smg.sample_id IN (SELECT id FROM s)
+                    GROUP BY smg.sample_id) t)
+        """.format(ids_sql), params)
+        minerals, num_regions, num_refs, num_grades = cursor.fetchone()
+
+    return {
+        'minerals': minerals or [],
+        'num_regions': num_regions or 0,
+        'num_refs': num_refs or 0,
+        'num_grades': num_grades or 0,
+    }
+
+
+def sample_clusters(qs, zoom, clustering='grid'):
+    """
+    Groups the samples of `qs` into clusters sized for the map zoom level
+    `zoom`, in a single aggregate query. Samples are grouped by the cell of
+    a regular grid they fall in or by their geohash prefix (`clustering`);
+    each cluster is returned with its size and the centroid of its samples,
+    plus the sample's id for clusters of one.
+    """
+    compiled = compiled_sql(qs.order_by().values('pk'))
+    if compiled is None:
+        return []
+    ids_sql, params = compiled
+
+    if clustering == 'geohash':
+        # a geohash cell gets 4 to 8 times narrower with every character;
+        # a tile, twice narrower with every zoom level
+        cell = 'ST_GeoHash(location_coords, %s)'
+        cell_params = [min(zoom // 2 + 1, 12)]
+    else:
+        size = 360.0 / 2 ** zoom * CLUSTER_CELL_PIXELS / 256
+        cell = ('ARRAY[floor(ST_X(location_coords) / %s), '
+                'floor(ST_Y(location_coords) / %s)]')
+        cell_params = [size, size]
+
+    with connections[qs.db].cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                count(*),
+                avg(ST_X(location_coords)),
+                avg(ST_Y(location_coords)),
+                CASE WHEN count(*) = 1 THEN min(id::text) END
+            FROM (
+                SELECT id, location_coords, {} AS cell
+                FROM samples
+                WHERE id IN ({})
+            ) s
+            GROUP BY cell
+        """.format(cell, ids_sql), cell_params + list(params))
+
+        return [{'count': count,
+                 'longitude': round(longitude, 5),
+                 'latitude': round(latitude, 5),
+                 'sample_id': sample_id}
+                for count, longitude, latitude, sample_id in cursor.fetchall()]
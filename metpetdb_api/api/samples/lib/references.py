@@ -0,0 +1,29 @@
+from apps.samples.models import GeoReference, Reference
+
+
+def georeference_ids(names):
+    """
+    Maps each of `names` to the pk of the GeoReference of that name,
+    creating the GeoReferences (and References) that don't exist yet.
+    """
+    names = set(name for name in names if name)
+    if not names:
+        return {}
+
+    georeferences = dict(GeoReference
+                         .objects
+                         .filter(name__in=names)
+                         .values_list('name', 'pk'))
+    missing = names - set(georeferences)
+    if missing:
+        new_georefs = GeoReference.objects.bulk_create(
+            [GeoReference(name=name) for name in missing])
+        georeferences.update((g.name, g.pk) for g in new_georefs)
+
+        existing_refs = set(Reference
+                            .objects
+                            .filter(name__in=missing)
+                            .values_list('name', flat=True))
+        Reference.objects.bulk_create([Reference(name=name)
+                                       for name in missing - existing_refs])
+    return georeferences
@@ -0,0 +1,105 @@
+"""
+Levels of detail of the metamorphic region shapes
+
+Besides its full shape, each metamorphic region has copies of it simplified
+for smaller map scales (shape_low, shape_medium and shape_high, computed by
+a trigger, see migration samples 0007). Clients pick one with either
+`simplify` (low, medium, high or none) or the `zoom` level of their map.
+
+Saving a region reassigns the samples inside and outside of its shape (see
+apps.samples.regions).
+"""
+from django.db.models.signals import post_save
+
+from api.samples.lib import search_cache
+from apps.common.utils import compiled_sql, server_side_rows
+from apps.samples.models import MetamorphicRegion
+from apps.samples.regions import assign_metamorphic_regions
+
+# the simplified shapes, from the coarsest, with the highest zoom level
+# each is detailed enough for
+SHAPE_LEVELS = (('low', 4), ('medium', 8), ('high', 12))
+
+SHAPE_COLUMNS = ('shape',) + tuple('shape_{}'.format(level)
+                                   for level, _ in SHAPE_LEVELS)
+
+# number of regions read at a time by the GeoJSON export
+GEOJSON_CHUNK_SIZE = 100
+
+
+def shape_level(params):
+    """
+    Returns the level of detail asked for by `params`, or None for the full
+    shapes; raises ValueError if it's invalid.
+    """
+    simplify = params.get('simplify')
+    if simplify:
+        if simplify == 'none':
+            return None
+        if simplify not in dict(SHAPE_LEVELS):
+            raise ValueError('Invalid simplify: {}'.format(simplify))
+        return simplify
+
+    zoom = params.get('zoom')
+    if zoom:
+        try:
+            zoom = int(zoom)
+        except ValueError:
+            raise ValueError('Invalid zoom: {}'.format(zoom))
+        for level, max_zoom in SHAPE_LEVELS:
+            if zoom <= max_zoom:
+                return level
+
+    return None
+
+
+def shape_column(level):
+    return 'shape' if level is None else 'shape_{}'.format(level)
+
+
+def regions_geojson(qs, level=None):
+    """
+    Streams the regions of `qs` as a GeoJSON FeatureCollection, with their
+    shapes at the given level of detail. The features are encoded by
+    PostGIS; Python only joins them.
+    """
+    compiled = compiled_sql(qs.order_by().values('pk'))
+    if compiled is None:
+        yield '{"type": "FeatureCollection", "features": []}'
+        return
+    ids_sql, params = compiled
+    sql = """
+        SELECT json_build_object(
+            'type', 'Feature',
+            'id', id,
+            'geometry', ST_AsGeoJSON({})::json,
+            'properties', json_build_object(
+                'name', name,
+                'description', description,
+                'label_location', ST_AsGeoJSON(label_location)::json
+            )
+        )::text
+        FROM metamorphic_regions
+        WHERE id IN ({})
+        ORDER BY name
+    """.format(shape_column(level), ids_sql)
+
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for rows in server_side_rows(sql, params, using=qs.db,
+                                 chunksize=GEOJSON_CHUNK_SIZE):
+        for feature, in rows:
+            yield separator + feature
+            separator = ','
+    yield ']}'
+
+
+def reassign_metamorphic_region(sender, instance, raw=False, **kwargs):
+    # the region's shape may have changed
+    if raw:
+        return
+    assign_metamorphic_regions(region_ids=[instance.pk])
+    search_cache.invalidate_sample_search(sender)
+
+
+post_save.connect(reassign_metamorphic_region, sender=MetamorphicRegion)
@@ -0,0 +1,134 @@
+"""
+Cache of sample search responses
+
+Identical searches are answered from the `sample_search` cache (see
+CACHES in the settings) instead of re-running sample_query and serializing
+the results again. The cache has to be shared by all the workers, e.g. a
+database, Redis or memcached one: the generation below lives in it too,
+and cached responses are compared with If-None-Match, so a process-local
+cache (apps.core.cache.LRUCache) is only right for a single worker.
+
+Responses are keyed by the canonical form of the query parameters and by
+who may see them: anonymous and public-only searches are shared by
+everyone, any other search is cached per user. Every key also carries the
+current generation of the cache, which writes to samples, their minerals,
+metamorphic regions and grades, references, subsamples and chemical
+analyses replace, so that a write makes all the cached searches
+unreachable at once. Entries are dropped after the cache's TIMEOUT anyway.
+
+Searches aren't cached if there is no `sample_search` cache.
+"""
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from apps.chemical_analyses.models import ChemicalAnalysis
+from apps.samples.models import Sample, SampleMineral, Subsample
+
+CACHE_ALIAS = 'sample_search'
+GENERATION_KEY = 'sample_search:generation'
+
+# query parameters holding comma separated sets, whose order doesn't matter
+SET_PARAMS = {'collectors', 'countries', 'elements', 'emails', 'fields',
+              'ids', 'metamorphic_grades', 'metamorphic_regions', 'minerals',
+              'numbers', 'owners', 'oxides', 'references', 'regions',
+              'rock_types', 'sesar_number'}
+
+
+def get_cache():
+    if CACHE_ALIAS not in settings.CACHES:
+        return None
+    return caches[CACHE_ALIAS]
+
+
+def visibility_class(user, params):
+    if isinstance(user, AnonymousUser) or params.get('provenance') == 'Public':
+        return 'public'
+    return 'owner:{}'.format(user.pk)
+
+
+def canonical_params(params):
+    canonical = []
+    for name in sorted(params):
+        values = [value for value in params.getlist(name) if value]
+        if not values:
+            continue
+        if name in SET_PARAMS:
+            values = [','.join(sorted(set(','.join(values).split(','))))]
+        canonical.append((name, values))
+    return canonical
+
+
+def get_generation(cache):
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.add(GENERATION_KEY, generation, timeout=None)
+        generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+def cache_key(request):
+    """
+    Returns the key of the response to `request`, or None if responses
+    aren't cached.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+
+    params = request.query_params
+    query = json.dumps([
+        request.build_absolute_uri(request.path),
+        request.accepted_renderer.format,
+        visibility_class(request.user, params),
+        canonical_params(params),
+    ])
+    return 'sample_search:{}:{}'.format(
+        get_generation(cache),
+        hashlib.md5(query.encode('utf-8')).hexdigest())
+
+
+def get_response(key):
+    if key is None:
+        return None
+    return get_cache().get(key)
+
+
+def set_response(key, value):
+    if key is not None:
+        get_cache().set(key, value)
+
+
+def invalidate():
+    cache = get_cache()
+    if cache is not None:
+        cache.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_sample_search(sender, **kwargs):
+    # once now, and again when the transaction commits, so that searches
+    # run before the commit can't be cached under the new generation
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def invalidate_on_m2m_change(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_sample_search(sender)
+
+
+for model in (Sample, SampleMineral, Subsample, ChemicalAnalysis):
+    post_save.connect(invalidate_sample_search, sender=model)
+    post_delete.connect(invalidate_sample_search, sender=model)
+
+for through in (Sample.metamorphic_regions.through,
+                Sample.metamorphic_grades.through,
+                Sample.references.through):
+    m2m_changed.connect(invalidate_on_m2m_change, sender=through)
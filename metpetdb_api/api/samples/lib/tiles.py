@@ -0,0 +1,161 @@
+"""
+Mapbox Vector Tiles of sample locations
+
+Tiles are encoded by PostGIS (ST_AsMVT) from the samples matching a search,
+with their id, number and rock type as attributes.
+
+Encoded tiles are kept on disk under SAMPLE_TILE_CACHE_DIR, as
+<generation>/<filter hash>/<z>/<x>/<y>.mvt: the filter hash stands for the
+search parameters and who may see the results (see search_cache), and the
+generation is the one of the sample search cache, so that the tiles go
+stale along with the cached searches. Tiles aren't cached without a
+SAMPLE_TILE_CACHE_DIR and a `sample_search` cache.
+"""
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from api.samples.lib import search_cache
+from apps.common.utils import compiled_sql
+
+MAX_TILE_ZOOM = 22
+
+# tiles are TILE_EXTENT units wide, and carry the points lying up to
+# TILE_BUFFER units past their edges so that symbols aren't cut off
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+# seconds after which unused generations of cached tiles are deleted
+TILE_CACHE_RETENTION = 60 * 60
+
+# half the width of the world in web mercator (EPSG:3857) metres
+MERCATOR_MAX = 20037508.342789244
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_to_lonlat(z, x, y):
+    # (x, y) may be fractional, and lie outside the grid of tiles
+    n = 2 ** z
+    y = min(max(y, 0), n)
+    lon = x / n * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+
+def sample_tile(qs, z, x, y):
+    """
+    Returns the vector tile z/x/y of the samples of `qs`, with a `samples`
+    layer holding their locations, ids, numbers and rock types.
+    """
+    size = 2 * MERCATOR_MAX / 2 ** z
+    envelope = [-MERCATOR_MAX + x * size, MERCATOR_MAX - (y + 1) * size,
+                -MERCATOR_MAX + (x + 1) * size, MERCATOR_MAX - y * size]
+
+    # the tile and its buffer in longitudes and latitudes, to pick the
+    # samples through the spatial index of location_coords
+    buffer = TILE_BUFFER / TILE_EXTENT
+    west, north = tile_to_lonlat(z, x - buffer, y - buffer)
+    east, south = tile_to_lonlat(z, x + 1 + buffer, y + 1 + buffer)
+
+    compiled = compiled_sql(qs.order_by().values('pk'))
+    if compiled is None:
+        # no sample can match; an empty tile is a valid one
+        return b''
+    ids_sql, params = compiled
+
+    with connections[qs.db].cursor() as cursor:
+        cursor.execute("""
+            SELECT ST_AsMVT(t, 'samples', %s, 'geom')
+            FROM (
+                SELECT
+                    s.id::text AS id,
+                    s.number,
+                    r.name AS rock_type,
+                    ST_AsMVTGeom(ST_Transform(s.location_coords, 3857),
+                                 ST_MakeEnvelope(%s, %s, %s, %s, 3857),
+                                 %s, %s, true) AS geom
+                FROM samples s
+                LEFT JOIN rock_types r ON r.id = s.rock_type_id
+                WHERE s.location_coords && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+                  AND s.id IN ({})
+            ) t
+            WHERE geom IS NOT NULL
+        """.format(ids_sql),
+            [TILE_EXTENT] + envelope + [TILE_EXTENT, TILE_BUFFER] +
+            [west, south, east, north] + list(params))
+        tile = cursor.fetchone()[0]
+
+    return bytes(tile) if tile is not None else b''
+
+
+def tile_path(request, z, x, y):
+    """
+    Returns the path of the cached tile z/x/y for the search of `request`,
+    or None if tiles aren't cached.
+    """
+    root = getattr(settings, 'SAMPLE_TILE_CACHE_DIR', None)
+    cache = search_cache.get_cache()
+    if not root or cache is None:
+        return None
+
+    params = request.query_params
+    search = json.dumps([
+        search_cache.visibility_class(request.user, params),
+        search_cache.canonical_params(params),
+    ])
+    return os.path.join(
+        root,
+        search_cache.get_generation(cache),
+        hashlib.md5(search.encode('utf-8')).hexdigest(),
+        str(z), str(x), '{}.mvt'.format(y))
+
+
+def read_tile(path):
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def write_tile(path, tile):
+    if path is None:
+        return
+
+    root = settings.SAMPLE_TILE_CACHE_DIR
+    generation = os.path.relpath(path, root).split(os.sep)[0]
+    if not os.path.isdir(os.path.join(root, generation)):
+        # the first tile of a new generation; drop the generations nobody
+        # has written to for a while (workers with process-local search
+        # caches may still be using theirs)
+        expiry = time.time() - TILE_CACHE_RETENTION
+        for name in os.listdir(root) if os.path.isdir(root) else []:
+            old = os.path.join(root, name)
+            try:
+                if os.path.getmtime(old) < expiry:
+                    shutil.rmtree(old, ignore_errors=True)
+            except OSError:
+                pass
+
+    # written to a temporary file first so that no one reads half a tile
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(tile)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the generation changed under us; the tile is stale anyway
+        pass
@@ -1,6 +1,18 @@
+import csv
+
 from rest_framework_csv import renderers as r
 
 
+class EchoBuffer(object):
+    """
+    A file-like object that hands back whatever is written to it, so that a
+    csv.writer can be used to produce lines for a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
 class SampleCSVRenderer (r.CSVRenderer):
 
     def __init__(self):
@@ -54,27 +66,7 @@ class SampleCSVRenderer (r.CSVRenderer):
             # with a generator in the first place? this looks silly)
             if 'minerals' in header:
                 data = tuple(data)
-                header.remove('minerals')
-                region_headers = []
-                for i in range(self.num_regions):
-                    region_headers.append('regions.' + str(i))
-                    labels[region_headers[-1]] = 'Region'
-                header[6:6] = region_headers
-                ref_headers = []
-                for i in range(self.num_refs):
-                    ref_headers.append('references.' + str(i))
-                    labels[ref_headers[-1]] = 'Reference'
-                offset = 10 + self.num_regions
-                header[offset:offset] = ref_headers
-                grade_headers = []
-                for i in range(self.num_grades):
-                    grade_headers.append('metamorphic_grades.' + str(i))
-                    labels[grade_headers[-1]] = 'Metamorphic Grade'
-                offset += self.num_refs
-                header[offset:offset] = grade_headers
-                mins = list(self.minerals)
-                mins.sort()
-                header.extend(mins)
+                self.build_header(header, labels)
 
             if labels:
                 yield [labels.get(x,x) for x in header]
@@ -94,6 +86,59 @@ class SampleCSVRenderer (r.CSVRenderer):
         else:
             pass
 
+    def build_header(self, header, labels):
+        """
+        Expands the `minerals` placeholder column into the dynamic region,
+        reference, metamorphic grade and mineral columns.
+        """
+        header.remove('minerals')
+        region_headers = []
+        for i in range(self.num_regions):
+            region_headers.append('regions.' + str(i))
+            labels[region_headers[-1]] = 'Region'
+        header[6:6] = region_headers
+        ref_headers = []
+        for i in range(self.num_refs):
+            ref_headers.append('references.' + str(i))
+            labels[ref_headers[-1]] = 'Reference'
+        offset = 10 + self.num_regions
+        header[offset:offset] = ref_headers
+        grade_headers = []
+        for i in range(self.num_grades):
+            grade_headers.append('metamorphic_grades.' + str(i))
+            labels[grade_headers[-1]] = 'Metamorphic Grade'
+        offset += self.num_refs
+        header[offset:offset] = grade_headers
+        mins = list(self.minerals)
+        mins.sort()
+        header.extend(mins)
+
+    def stream(self, columns, chunks):
+        """
+        Yields the CSV export line by line from an iterable of serialized
+        sample chunks. `columns` is the precomputed dynamic column set (see
+        api.samples.lib.query.sample_csv_columns), so the rows never have to
+        be held in memory to work out the header.
+        """
+        self.num_regions = columns['num_regions']
+        self.num_refs = columns['num_refs']
+        self.num_grades = columns['num_grades']
+        self.minerals = set(columns['minerals'])
+
+        header = list(self.header)
+        labels = dict(self.labels)
+        self.build_header(header, labels)
+
+        buffer = EchoBuffer()
+        writer = csv.writer(buffer)
+        yield writer.writerow([labels.get(x, x) for x in header])
+
+        for chunk in chunks:
+            for item in chunk:
+                self.handle_minerals(item)
+                item = self.flatten_item(item)
+                yield writer.writerow([item.get(key, None) for key in header])
+
     def flatten_data(self,data):
         for item in data:
             self.handle_regions(item)
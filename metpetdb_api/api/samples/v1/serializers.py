@@ -1,6 +1,10 @@
+from collections import defaultdict
+
 from rest_framework import serializers
 
 from api.lib.serializers import DynamicFieldsModelSerializer
+from api.lib.vocabulary import vocabulary
+from api.samples.lib.regions import shape_column
 from api.users.v1.serializers import UserSerializer
 
 from apps.chemical_analyses.models import ChemicalAnalysis
@@ -48,6 +52,46 @@ class SampleMineralSerializer(DynamicFieldsModelSerializer):
         fields = ('id', 'name', 'amount', 'real_mineral_id',)
 
 
+class SampleListSerializer(serializers.ListSerializer):
+    """
+    Resolves the subsample and chemical analysis ids of every sample in the
+    page with one grouped query each, instead of two queries per sample.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if hasattr(data, 'all') else data
+        samples = list(iterable)
+        attach_related_ids(samples, self.child.fields)
+        return super().to_representation(samples)
+
+
+def attach_related_ids(samples, fields):
+    if not samples:
+        return
+
+    sample_ids = [sample.pk for sample in samples]
+
+    if 'subsample_ids' in fields:
+        subsample_ids = defaultdict(list)
+        for sample_id, id in (Subsample
+                              .objects
+                              .filter(sample_id__in=sample_ids)
+                              .values_list('sample_id', 'id')):
+            subsample_ids[sample_id].append(id)
+        for sample in samples:
+            sample._subsample_ids = subsample_ids[sample.pk]
+
+    if 'chemical_analyses_ids' in fields:
+        chemical_analyses_ids = defaultdict(list)
+        for sample_id, id in (ChemicalAnalysis
+                              .objects
+                              .filter(subsample__sample_id__in=sample_ids)
+                              .values_list('subsample__sample_id', 'id')):
+            chemical_analyses_ids[sample_id].append(id)
+        for sample in samples:
+            sample._chemical_analyses_ids = chemical_analyses_ids[sample.pk]
+
+
 class SampleSerializer(DynamicFieldsModelSerializer):
     minerals = SampleMineralSerializer(source='samplemineral_set',
                                        many=True)
@@ -62,13 +106,14 @@ class SampleSerializer(DynamicFieldsModelSerializer):
     longitude = serializers.SerializerMethodField(read_only=True)
     collection_date = serializers.SerializerMethodField(read_only=True)
 
-    # TODO: figure out if there is a better, more efficient way to do this
+    # resolved in bulk by SampleListSerializer when serializing many samples
     subsample_ids = serializers.SerializerMethodField()
     chemical_analyses_ids = serializers.SerializerMethodField()
 
     class Meta:
         model = Sample
         depth = 1
+        list_serializer_class = SampleListSerializer
         fields = (
             'number',
             'owner',
@@ -100,9 +145,8 @@ class SampleSerializer(DynamicFieldsModelSerializer):
 
         if self.initial_data.get('rock_type_id'):
             self._validated_data.update(
-                {'rock_type': (RockType
-                               .objects
-                               .get(pk=self.initial_data['rock_type_id']))
+                {'rock_type': (vocabulary(RockType)
+                               .get(self.initial_data['rock_type_id']))
                  }
             )
 
@@ -154,9 +198,13 @@ class SampleSerializer(DynamicFieldsModelSerializer):
         return '' if date == 'None' else date
 
     def get_subsample_ids(self, obj):
+        if hasattr(obj, '_subsample_ids'):
+            return obj._subsample_ids
         return Subsample.objects.filter(sample_id=obj.pk).values_list('id', flat=True)
 
     def get_chemical_analyses_ids(self, obj):
+        if hasattr(obj, '_chemical_analyses_ids'):
+            return obj._chemical_analyses_ids
         subsample_ids = obj.subsamples.values_list('id', flat=True)
         return ChemicalAnalysis.objects.filter(
             subsample_id__in=subsample_ids).values_list('id', flat=True)
@@ -219,9 +267,24 @@ class MetamorphicGradeSerializer(DynamicFieldsModelSerializer):
         model = MetamorphicGrade
 
 
+class ShapeField(serializers.ReadOnlyField):
+    def to_representation(self, value):
+        return str(value)
+
+
 class MetamorphicRegionSerializer(DynamicFieldsModelSerializer):
     class Meta:
         model = MetamorphicRegion
+        exclude = ('shape_low', 'shape_medium', 'shape_high')
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # the shape at the level of detail picked by the view, read from its
+        # own column; the full shape isn't loaded then
+        level = self.context.get('shape_level')
+        if level is not None and 'shape' in fields:
+            fields['shape'] = ShapeField(source=shape_column(level))
+        return fields
 
 
 class GeoReferenceSerializer(DynamicFieldsModelSerializer):
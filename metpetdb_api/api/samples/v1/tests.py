@@ -1,16 +1,32 @@
+import base64
 import json
 import random
 from copy import deepcopy
-
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from django.contrib.gis.geos import Point
+from django.core.signals import request_started
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
+from api.lib.vocabulary import vocabulary
+from api.samples.lib.query import parse_polygon
+from apps.chemical_analyses.models import ChemicalAnalysis
+from apps.core.pagination import EstimatedCountPaginator
 from apps.samples.models import (
     GeoReference,
     MetamorphicGrade,
     MetamorphicRegion,
     Mineral,
     RockType,
+    Sample,
+    SampleMineral,
+    Subsample,
+    SubsampleType,
 )
 from apps.users.models import User
 
@@ -314,4 +330,579 @@ class SampleTests(APITestCase):
         ##searching with private provenance on another user should return none
         res = client.get('/api/samples/',{"owner":[self.superuser1],"provenance":["Private"]})
         res_json_private = json.loads(res.content.decode('utf-8'))
-        self.assertEqual(0,res_json_private['count'])
\ No newline at end of file
+        self.assertEqual(0,res_json_private['count'])
+
+
+    def test_sample_list_includes_subsample_and_chemical_analyses_ids(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        sample = Sample.objects.filter(public_data=True)[0]
+        subsample_type = SubsampleType.objects.create(name=get_random_str())
+        subsample = Subsample.objects.create(name=get_random_str(),
+                                             sample=sample,
+                                             owner=self.contributor1,
+                                             subsample_type=subsample_type)
+        chemical_analysis = ChemicalAnalysis.objects.create(
+            subsample=subsample,
+            owner=self.contributor1,
+            spot_id=1,
+        )
+
+        res = client.get('/api/samples/', {'page_size': 10})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        res_json = json.loads(res.content.decode('utf-8'))
+
+        results = {r['number']: r for r in res_json['results']}
+        self.assertEqual(results[sample.number]['subsample_ids'],
+                         [str(subsample.pk)])
+        self.assertEqual(results[sample.number]['chemical_analyses_ids'],
+                         [str(chemical_analysis.pk)])
+        for number, result in results.items():
+            if number != sample.number:
+                self.assertEqual(result['subsample_ids'], [])
+                self.assertEqual(result['chemical_analyses_ids'], [])
+
+
+    def test_cursor_pagination_walks_every_sample_once(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        for i in range(5):
+            sample_data = deepcopy(self.public_data_1)
+            sample_data['number'] = get_random_str()
+            client.post('/api/samples/', sample_data)
+
+        seen = []
+        params = {'pagination': 'cursor', 'page_size': 2,
+                  'ordering': 'number'}
+        while True:
+            res = client.get('/api/samples/', params)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            res_json = json.loads(res.content.decode('utf-8'))
+            self.assertNotIn('count', res_json)
+            seen.extend(r['number'] for r in res_json['results'])
+            if not res_json['next']:
+                break
+            next_query = parse_qs(urlparse(res_json['next']).query)
+            params['cursor'] = next_query['cursor'][0]
+
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+        res = client.get('/api/samples/', {'pagination': 'cursor',
+                                           'ordering': 'owner__password'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(['number', 'x', 'not-a-uuid']).encode('utf-8'))
+        res = client.get('/api/samples/', {'pagination': 'cursor',
+                                           'ordering': 'number',
+                                           'cursor': cursor.decode('ascii')})
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_csv_export_includes_dynamic_mineral_columns(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        res = client.get('/api/samples/', {'format': 'csv'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.streaming)
+
+        lines = b''.join(res.streaming_content).decode('utf-8').splitlines()
+        header = lines[0].split(',')
+        self.assertIn(self.minerals[0].name, header)
+        self.assertIn(self.minerals[1].name, header)
+        self.assertNotIn(self.minerals[2].name, header)
+        self.assertEqual(len(lines), 3)
+
+        res = client.get('/api/samples/', {'format': 'csv',
+                                           'minerals': 'Unobtainium',
+                                           'minerals_and': 'True'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        lines = b''.join(res.streaming_content).decode('utf-8').splitlines()
+        self.assertLessEqual(len(lines), 1)
+
+
+    def test_vocabulary_follows_writes_to_its_table(self):
+        minerals = vocabulary(Mineral)
+        self.assertEqual(minerals.lookup('name', ['Garnet']), {})
+
+        # bulk inserts send no signals; the version stamp, read again in
+        # the next request, catches them
+        garnet, = Mineral.objects.bulk_create([Mineral(name='Garnet')])
+        garnet_id = garnet.pk
+        self.assertEqual(minerals.lookup('name', ['Garnet']), {})
+        request_started.send(sender=None)
+        self.assertEqual(minerals.lookup('name', ['Garnet']),
+                         {'Garnet': garnet_id})
+        self.assertEqual(minerals.get(str(garnet_id)).name, 'Garnet')
+
+        garnet.delete()
+        with self.assertRaises(Mineral.DoesNotExist):
+            minerals.get(garnet_id)
+
+
+    def test_unchanged_sample_list_is_not_modified(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        sample_data = deepcopy(self.sample_data)
+        res = client.post('/api/samples/', sample_data)
+        sample_id = json.loads(res.content.decode('utf-8'))['id']
+
+        res = client.get('/api/samples/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        etag = res['ETag']
+
+        res = client.get('/api/samples/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res['ETag'], etag)
+
+        sample_data['number'] = get_random_str()
+        client.put('/api/samples/{}/'.format(sample_id), sample_data)
+
+        res = client.get('/api/samples/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+
+        # searches that can't match anything are answered without a query
+        params = {'minerals': 'Unobtainium', 'minerals_and': 'True'}
+        res = client.get('/api/samples/', params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 0)
+        res = client.get('/api/samples/', params,
+                         HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'sample_search': {
+            'BACKEND': 'apps.core.cache.LRUCache',
+            'LOCATION': 'sample-search-tests',
+        },
+    })
+    def test_sample_search_is_cached_until_a_sample_changes(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        anonymous = APIClient()
+        res = anonymous.get('/api/samples/')
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 1)
+
+        with self.assertNumQueries(0):
+            res = anonymous.get('/api/samples/')
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 1)
+
+        public_data = deepcopy(self.public_data_1)
+        public_data['number'] = get_random_str()
+        client.post('/api/samples/', public_data)
+
+        res = anonymous.get('/api/samples/')
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 2)
+
+
+    def test_mineral_search_matches_all_or_any_of_the_minerals(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        client.post('/api/samples/', deepcopy(self.public_data_1))
+
+        sample_data = deepcopy(self.public_data_1)
+        sample_data['number'] = get_random_str()
+        sample_data['minerals'] = [{"id": str(self.minerals[1].pk),
+                                    "amount": "x"}]
+        client.post('/api/samples/', sample_data)
+
+        minerals = '{},{}'.format(self.minerals[0].name, self.minerals[1].name)
+
+        res = client.get('/api/samples/', {'minerals': minerals,
+                                           'minerals_and': 'True'})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 1)
+
+        res = client.get('/api/samples/', {'minerals': minerals})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 2)
+
+        res = client.get('/api/samples/', {'minerals': minerals + ',x',
+                                           'minerals_and': 'True'})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 0)
+
+
+    def test_polygon_within_excludes_samples_only_inside_its_bbox(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        # the samples lie inside the triangle's bounding box, not inside it
+        triangle = json.dumps([[-117, 48], [-117, 50], [-119, 50], [-117, 48]])
+
+        res = client.get('/api/samples/', {'polygon_coords': triangle})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 2)
+
+        res = client.get('/api/samples/', {'polygon_coords': triangle,
+                                           'polygon_within': 'True'})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 0)
+
+        # each search gets a polygon of its own
+        self.assertIsNot(parse_polygon(triangle), parse_polygon(triangle))
+
+    def test_sample_clusters(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        res = client.get('/api/samples/clusters/', {'zoom': 3})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        clusters = json.loads(res.content.decode('utf-8'))['clusters']
+        self.assertEqual(sum(c['count'] for c in clusters), 2)
+
+        res = client.get('/api/samples/clusters/', {'zoom': 3,
+                                                    'clustering': 'geohash'})
+        clusters = json.loads(res.content.decode('utf-8'))['clusters']
+        self.assertEqual(sum(c['count'] for c in clusters), 2)
+
+        res = client.get('/api/samples/clusters/', {'zoom': 'far'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = client.get('/api/samples/clusters/',
+                         {'zoom': 3, 'minerals': 'Unobtainium',
+                          'minerals_and': 'True'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            json.loads(res.content.decode('utf-8'))['clusters'], [])
+
+    def test_sample_tiles(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        res = client.get('/api/samples/tiles/0/0/0.mvt')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'],
+                         'application/vnd.mapbox-vector-tile')
+        self.assertTrue(res.content)
+
+        res = client.get('/api/samples/tiles/1/2/0.mvt')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = client.get('/api/samples/tiles/0/0/0.mvt',
+                         {'minerals': 'Unobtainium', 'minerals_and': 'True'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.content, b'')
+
+    def test_metamorphic_region_shapes_are_simplified(self):
+        client = APIClient()
+        region = MetamorphicRegion.objects.create(
+            name=get_random_str(),
+            shape=Point(-118, 49, srid=4326).buffer(1, quadsegs=256)
+        )
+        url = '/api/metamorphic_regions/{}/'.format(region.pk)
+
+        full = json.loads(client.get(url).content.decode('utf-8'))['shape']
+        low = json.loads(client.get(url, {'zoom': 2})
+                         .content.decode('utf-8'))['shape']
+        self.assertLess(len(low), len(full))
+
+        res = client.get('/api/metamorphic_regions/', {'geojson': 'True',
+                                                       'simplify': 'low'})
+        geojson = json.loads(b''.join(res.streaming_content).decode('utf-8'))
+        self.assertEqual(len(geojson['features']),
+                         len(self.metamorphic_regions) + 1)
+
+        res = client.get('/api/metamorphic_regions/', {'simplify': 'lots'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # the simplified shapes are read along with the regions, whatever
+        # their number
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                res = client.get('/api/metamorphic_regions/',
+                                 {'simplify': 'low'})
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        before = count_queries()
+        for i in range(3):
+            MetamorphicRegion.objects.create(
+                name=get_random_str(),
+                shape=Point(-118, 49, srid=4326).buffer(1))
+        self.assertEqual(count_queries(), before)
+
+    def test_samples_are_assigned_to_the_regions_containing_them(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        region = MetamorphicRegion.objects.create(
+            name=get_random_str(),
+            shape=Point(-118, 49, srid=4326).buffer(1)
+        )
+        self.assertEqual(region.sample_set.count(), 2)
+
+        # new samples are assigned on save
+        client.post('/api/samples/', deepcopy(self.public_data_1))
+        self.assertEqual(region.sample_set.count(), 3)
+
+        res = client.get('/api/samples/')
+        etag = res['ETag']
+
+        region.shape = Point(0, 0, srid=4326).buffer(1)
+        region.save()
+        self.assertEqual(region.sample_set.count(), 0)
+
+        # the samples' representation changed along with their regions
+        res = client.get('/api/samples/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_estimated_count_pagination(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        for i in range(5):
+            sample_data = deepcopy(self.public_data_1)
+            sample_data['number'] = get_random_str()
+            client.post('/api/samples/', sample_data)
+
+        params = {'pagination': 'estimated', 'page_size': 2}
+        res_json = json.loads(client.get('/api/samples/', params)
+                              .content.decode('utf-8'))
+        self.assertEqual(res_json['count'], 5)
+        self.assertFalse(res_json['count_is_estimate'])
+
+        res = client.get('/api/samples/', dict(params,
+                                               minerals='Unobtainium',
+                                               minerals_and='True'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 0)
+
+        # every page stays reachable whatever the estimate
+        with mock.patch.object(EstimatedCountPaginator,
+                               'estimate_threshold', -1):
+            seen = []
+            url = '/api/samples/'
+            while url:
+                res = client.get(url, params if url == '/api/samples/'
+                                 else None)
+                res_json = json.loads(res.content.decode('utf-8'))
+                self.assertTrue(res_json['count_is_estimate'])
+                seen.extend(r['number'] for r in res_json['results'])
+                url = res_json['next']
+            self.assertEqual(len(set(seen)), 5)
+
+    def test_fields_limit_the_loaded_columns(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        res = client.get('/api/samples/',
+                         {'fields': 'number,latitude,longitude'})
+        results = json.loads(res.content.decode('utf-8'))['results']
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertEqual(set(result), {'number', 'latitude', 'longitude'})
+            self.assertEqual(result['longitude'], -118.40089)
+            self.assertEqual(result['latitude'], 49.16951)
+
+    def test_cross_filters_match_each_row_once(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+
+        sample = Sample.objects.filter(public_data=True)[0]
+        subsample = Subsample.objects.create(
+            name=get_random_str(),
+            sample=sample,
+            owner=self.contributor1,
+            subsample_type=SubsampleType.objects.create(name=get_random_str())
+        )
+        for spot_id in range(2):
+            ChemicalAnalysis.objects.create(subsample=subsample,
+                                            owner=self.contributor1,
+                                            spot_id=spot_id)
+
+        res = client.get('/api/samples/',
+                         {'chemical_analyses_filters': 'True'})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 1)
+
+        # sample filters apply along with the analysis filters
+        res = client.get('/api/samples/',
+                         {'chemical_analyses_filters': 'True',
+                          'location_bbox': '0,0,1,1'})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 0)
+
+        res = client.get('/api/chemical_analyses/',
+                         {'sample_filters': 'True',
+                          'numbers': sample.number})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 2)
+
+        # provenance applies to the samples too: a private sample with a
+        # public analysis isn't a public search result
+        private = Sample.objects.filter(public_data=False,
+                                        owner=self.contributor1)[0]
+        ChemicalAnalysis.objects.create(
+            subsample=Subsample.objects.create(
+                name=get_random_str(),
+                sample=private,
+                owner=self.contributor1,
+                subsample_type=subsample.subsample_type),
+            owner=self.contributor1,
+            public_data=True,
+            spot_id=3)
+        res = client.get('/api/samples/',
+                         {'chemical_analyses_filters': 'True',
+                          'provenance': 'Public'})
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['count'], 0)
+
+        # analysis filters that can't match anything
+        for path, params in (('/api/samples/',
+                              {'chemical_analyses_filters': 'True',
+                               'elements': 'Unobtainium',
+                               'elements_and': 'True'}),
+                             ('/api/chemical_analyses/',
+                              {'sample_filters': 'True',
+                               'minerals': 'Unobtainium',
+                               'minerals_and': 'True'})):
+            res = client.get(path, params)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                json.loads(res.content.decode('utf-8'))['count'], 0)
+
+    def test_batch_get_returns_the_visible_samples_in_order(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+        public = Sample.objects.get(public_data=True)
+        private = Sample.objects.get(public_data=False)
+        ids = [str(private.pk), str(public.pk)]
+
+        res = client.post('/api/samples/batch_get/?fields=number',
+                          {'ids': ids}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['results'],
+                         [{'number': private.number},
+                          {'number': public.number}])
+
+        # anonymous users only get the public ones
+        res = APIClient().post('/api/samples/batch_get/?fields=number',
+                               {'ids': ids}, format='json')
+        self.assertEqual(json.loads(res.content.decode('utf-8'))['results'],
+                         [{'number': public.number}])
+
+        res = client.post('/api/samples/batch_get/', {'ids': ['nope']},
+                          format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_creates_and_updates_samples_together(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        self.provenance_helper(client)
+        sample = Sample.objects.get(public_data=True)
+
+        new_sample = deepcopy(self.sample_data)
+        new_sample['references'] = [get_random_str()]
+        edit = {'id': str(sample.pk),
+                'description': 'edited',
+                'minerals': [{'id': str(self.minerals[2].pk),
+                              'amount': 'x'}]}
+
+        res = client.post('/api/samples/batch/', [new_sample, edit],
+                          format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        results = json.loads(res.content.decode('utf-8'))
+        self.assertEqual([r['status'] for r in results],
+                         ['created', 'updated'])
+
+        created = Sample.objects.get(pk=results[0]['id'])
+        self.assertEqual(created.owner, self.contributor1)
+        self.assertEqual(created.metamorphic_grades.count(),
+                         len(self.metamorphic_grades))
+        self.assertEqual(created.references.count(), 1)
+
+        sample.refresh_from_db()
+        self.assertEqual(sample.description, 'edited')
+        self.assertEqual(sample.mineral_ids, [self.minerals[2].pk])
+
+        # nothing is written if any of the samples is invalid
+        edit['description'] = 'edited again'
+        res = client.post('/api/samples/batch/',
+                          [edit, dict(new_sample, rock_type_id='nope')],
+                          format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        results = json.loads(res.content.decode('utf-8'))
+        self.assertEqual([r['status'] for r in results], ['valid', 'invalid'])
+        sample.refresh_from_db()
+        self.assertEqual(sample.description, 'edited')
+
+        # edits write the fields they give, and bump the version
+        version = sample.version
+        res = client.post('/api/samples/batch/',
+                          [{'id': str(sample.pk), 'number': 'renumbered'}],
+                          format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        sample.refresh_from_db()
+        self.assertEqual(sample.number, 'renumbered')
+        self.assertEqual(sample.description, 'edited')
+        self.assertEqual(sample.mineral_ids, [self.minerals[2].pk])
+        self.assertEqual(sample.version, version + 1)
+
+
+    def test_update_keeps_the_unchanged_related_rows(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.contributor1.auth_token.key
+        )
+        sample_data = deepcopy(self.sample_data)
+        res = client.post('/api/samples/', sample_data, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        sample_id = json.loads(res.content.decode('utf-8'))['id']
+
+        kept = SampleMineral.objects.get(sample_id=sample_id,
+                                         mineral=self.minerals[0])
+        sample_data['minerals'] = [
+            {'id': str(self.minerals[0].pk), 'amount': 'y'},
+            {'id': str(self.minerals[2].pk), 'amount': 'x'},
+        ]
+        res = client.put('/api/samples/{}/'.format(sample_id), sample_data,
+                         format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        rows = {row.mineral_id: row for row in
+                SampleMineral.objects.filter(sample_id=sample_id)}
+        self.assertEqual(set(rows),
+                         {self.minerals[0].pk, self.minerals[2].pk})
+        self.assertEqual(rows[self.minerals[0].pk].pk, kept.pk)
+        self.assertEqual(rows[self.minerals[0].pk].amount, 'y')
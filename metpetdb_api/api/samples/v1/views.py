@@ -1,14 +1,40 @@
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import permissions, status, viewsets
+from rest_framework.decorators import list_route
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from api.samples.v1.renderers import SampleCSVRenderer
 
-from api.chemical_analyses.lib.query import chemical_analysis_query
+from api.lib.batch import batch_ids, in_order
 from api.lib.permissions import IsOwnerOrReadOnly, IsSuperuserOrReadOnly
-from api.lib.query import sample_qs_optimizer, chemical_analyses_qs_optimizer
-
-from api.samples.lib.query import sample_query
+from api.lib.query import sample_qs_optimizer, subsample_qs_optimizer
+from api.lib.search import samples_with_analyses
+from api.lib.vocabulary import vocabulary
+
+from api.samples.lib import search_cache
+from api.samples.lib.batch_write import SampleBatchWriter
+from api.samples.lib.query import (
+    CLUSTERINGS,
+    MAX_CLUSTER_ZOOM,
+    sample_clusters,
+    sample_csv_columns,
+    sample_query,
+)
+from api.samples.lib.references import georeference_ids
+from api.samples.lib.regions import (
+    SHAPE_COLUMNS,
+    regions_geojson,
+    shape_column,
+    shape_level,
+)
+from api.samples.lib.tiles import (
+    read_tile,
+    sample_tile,
+    tile_path,
+    valid_tile,
+    write_tile,
+)
 from api.samples.v1.serializers import (
     SampleSerializer,
     RockTypeSerializer,
@@ -22,7 +48,9 @@ from api.samples.v1.serializers import (
     GeoReferenceSerializer,
     SubsampleTypeSerializer,
 )
-from apps.chemical_analyses.models import ChemicalAnalysis
+from apps.common.utils import server_side_chunks, sync_related_rows
+from apps.core.conditional import ConditionalGetMixin
+from apps.core.pagination import PaginationModeMixin
 from apps.samples.models import (
     Country,
     Sample,
@@ -38,13 +66,40 @@ from apps.samples.models import (
     GeoReference,
     SubsampleType,
 )
+from apps.samples.regions import assign_metamorphic_regions
+
+
+def search_samples(request, qs):
+    """
+    Returns the samples of `qs` matching the search parameters of
+    `request`; raises ValueError if they are invalid.
+    """
+    params = request.query_params
+
+    if params.get('chemical_analyses_filters') == 'True':
+        return samples_with_analyses(request.user, params, qs.distinct())
+
+    return sample_query(request.user, params, qs.distinct())
+
+
+# number of samples loaded and serialized at a time by the CSV export
+CSV_CHUNK_SIZE = 500
+
 
-class SampleViewSet(viewsets.ModelViewSet):
+class SampleViewSet(ConditionalGetMixin, PaginationModeMixin,
+                    viewsets.ModelViewSet):
     queryset = Sample.objects.all()
     serializer_class = SampleSerializer
     renderer_classes = (JSONRenderer, BrowsableAPIRenderer, SampleCSVRenderer)
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,
                           IsOwnerOrReadOnly,)
+    # the fields cursor pagination may order by
+    ordering_fields = ('pk', 'number', 'collection_date', 'country',
+                       'location_name', 'collector_name')
+    # samples are serialized with the ids of their subsamples and chemical
+    # analyses
+    etag_fields = ('pk', 'version', 'subsamples__id',
+                   'subsamples__chemical_analyses__id')
 
     def get_serializer(self, *args, **kwargs):
         if self.request.method == 'PUT':
@@ -55,102 +110,203 @@ class SampleViewSet(viewsets.ModelViewSet):
     def list(self, request, *args, **kwargs):
         params = request.query_params
 
-        if params.get('chemical_analyses_filters') == 'True':
-            chem_qs = ChemicalAnalysis.objects.all()
-            chem_qs = chemical_analyses_qs_optimizer(params, chem_qs)
-            chem_ids = (chemical_analysis_query(request.user, params, chem_qs)
-                        .values_list('id'))
-            qs = (Sample
-                  .objects
-                  .filter(subsamples__chemical_analyses__id__in=chem_ids))
+        # CSV exports are streamed rather than cached
+        cache_key = None
+        if params.get('format') != 'csv':
+            cache_key = search_cache.cache_key(request)
+            cached = search_cache.get_response(cache_key)
+            if cached is not None:
+                self.etag, data = cached
+                return self.not_modified() or Response(data)
+
+        try:
+            qs = search_samples(request, self.get_queryset())
+        except ValueError as err:
+            return Response(
+                data={'error': err.args},
+                status=400
+            )
+
+        qs = sample_qs_optimizer(params, qs)
+
+        # streamed exports get no ETag: working one out would take a pass
+        # over every row before the first one is sent
+        if params.get('format') == 'csv':
+            return self._stream_csv(params, qs)
+
+        page = self.paginate_queryset(qs)
+        rows = page if page is not None else list(qs)
+        not_modified = self.check_etag(qs, rows, paginated=page is not None)
+        if not_modified is not None:
+            return not_modified
+
+        serializer = self.get_serializer(rows, many=True)
+        if page is not None:
+            response = self.get_paginated_response(serializer.data)
         else:
-            qs = self.get_queryset().distinct()
+            response = Response(serializer.data)
+
+        search_cache.set_response(cache_key, (self.etag, response.data))
+        return response
+
+
+    @list_route(methods=['post'],
+                permission_classes=(permissions.AllowAny,),
+                renderer_classes=(JSONRenderer, BrowsableAPIRenderer))
+    def batch_get(self, request):
+        """
+        The samples whose ids are listed in the body (`{"ids": [...]}`),
+        those the user may see only, in the order given; the `fields` and
+        search parameters of the list apply.
+        """
+        try:
+            ids = batch_ids(request.data)
+            qs = search_samples(request,
+                                self.get_queryset().filter(pk__in=ids))
+        except ValueError as err:
+            return Response(
+                data={'error': err.args},
+                status=400
+            )
+
+        qs = sample_qs_optimizer(request.query_params, qs)
+        serializer = self.get_serializer(in_order(qs, ids), many=True)
+        return Response({'results': serializer.data})
+
+
+    @list_route(methods=['post'],
+                renderer_classes=(JSONRenderer, BrowsableAPIRenderer))
+    def batch(self, request):
+        """
+        Creates and updates the samples of a list of sample payloads, shaped
+        like those of create (or update, given an `id`), in one
+        transaction; returns the status of each of them.
+        """
+        try:
+            results, written = SampleBatchWriter(request.user).write(
+                request.data)
+        except ValueError as err:
+            return Response(
+                data={'error': err.args},
+                status=400
+            )
+
+        return Response(results,
+                        status=(status.HTTP_200_OK if written
+                                else status.HTTP_400_BAD_REQUEST))
+
+
+    @list_route(methods=['get'],
+                renderer_classes=(JSONRenderer, BrowsableAPIRenderer))
+    def clusters(self, request):
+        """
+        Clusters of the samples matching the search parameters, for map
+        views: `zoom` (0-20) sets the size of the clusters, and `clustering`
+        is either `grid` (the default) or `geohash`. Use location_bbox to
+        restrict the clusters to the area on display.
+        """
+        params = request.query_params
+
+        try:
+            zoom = int(params.get('zoom', 0))
+        except ValueError:
+            zoom = None
+        if zoom is None or not 0 <= zoom <= MAX_CLUSTER_ZOOM:
+            return Response(data={'error': 'Invalid zoom'}, status=400)
+
+        clustering = params.get('clustering', 'grid')
+        if clustering not in CLUSTERINGS:
+            return Response(data={'error': 'Invalid clustering'}, status=400)
+
+        cache_key = search_cache.cache_key(request)
+        data = search_cache.get_response(cache_key)
+        if data is None:
             try:
-                qs = sample_query(request.user, params, qs)
+                qs = search_samples(request, self.get_queryset())
             except ValueError as err:
                 return Response(
                     data={'error': err.args},
                     status=400
                 )
+            data = {
+                'zoom': zoom,
+                'clustering': clustering,
+                'clusters': sample_clusters(qs, zoom, clustering),
+            }
+            search_cache.set_response(cache_key, data)
+
+        return Response(data)
+
+
+    def _stream_csv(self, params, qs):
+        columns = sample_csv_columns(qs)
+        renderer = SampleCSVRenderer()
+        return StreamingHttpResponse(
+            renderer.stream(columns, self._serialized_chunks(params, qs)),
+            content_type=renderer.media_type
+        )
 
-        qs = sample_qs_optimizer(params, qs)
 
-        if params.get('format') == 'csv':
-            serializer = self.get_serializer(qs, many=True)
-            return Response(serializer.data)
-        else:
-            page = self.paginate_queryset(qs)
-            if page:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
+    def _serialized_chunks(self, params, qs):
+        for ids in server_side_chunks(qs, chunksize=CSV_CHUNK_SIZE):
+            samples = sample_qs_optimizer(params,
+                                          Sample.objects.filter(pk__in=ids))
+            samples = {sample.pk: sample for sample in samples}
+            serializer = self.get_serializer([samples[id] for id in ids],
+                                             many=True)
+            yield serializer.data
 
-            serializer = self.get_serializer(qs, many=True)
-            return Response(serializer.data)
+
+    def _lookup_ids(self, model, ids, kind):
+        pks = vocabulary(model).lookup('pk', ids)
+        for id in ids:
+            if str(id) not in pks:
+                raise ValueError('Invalid {} id: {}'.format(kind, id))
+        return set(pks.values())
 
 
     def _handle_metamorphic_regions(self, instance, ids):
-        metamorphic_regions = []
-        for id in ids:
-            try:
-                metamorphic_region = MetamorphicRegion.objects.get(pk=id)
-            except:
-                raise ValueError('Invalid metamorphic_region id: {}'
-                                 .format(id))
-            else:
-                metamorphic_regions.append(metamorphic_region)
-        instance.metamorphic_regions = metamorphic_regions
+        sync_related_rows(
+            Sample.metamorphic_regions.through,
+            'sample_id', 'metamorphicregion_id',
+            {instance.pk: self._lookup_ids(MetamorphicRegion, ids,
+                                           'metamorphic_region')})
 
 
     def _handle_metamorphic_grades(self, instance, ids):
-        metamorphic_grades = []
-        for id in ids:
-            try:
-                metamorphic_grade = MetamorphicGrade.objects.get(pk=id)
-            except:
-                raise ValueError('Invalid metamorphic_grade id: {}'.format(id))
-            else:
-                metamorphic_grades.append(metamorphic_grade)
-        instance.metamorphic_grades = metamorphic_grades
+        sync_related_rows(
+            Sample.metamorphic_grades.through,
+            'sample_id', 'metamorphicgrade_id',
+            {instance.pk: self._lookup_ids(MetamorphicGrade, ids,
+                                           'metamorphic_grade')})
 
 
     def _handle_minerals(self, instance, minerals):
-        to_add = []
+        mineral_pks = vocabulary(Mineral).lookup(
+            'pk', (record['id'] for record in minerals))
+        amounts = {}
         for record in minerals:
             try:
-                to_add.append(
-                    {'mineral': Mineral.objects.get(pk=record['id']),
-                     'amount': record['amount']})
-            except Mineral.DoesNotExist:
+                amounts[mineral_pks[str(record['id'])]] = {
+                    'amount': record['amount']}
+            except KeyError:
                 raise ValueError('Invalid mineral id: {}'.format(record['id']))
 
-        SampleMineral.objects.filter(sample=instance).delete()
-        for record in to_add:
-            SampleMineral.objects.create(sample=instance,
-                                         mineral=record['mineral'],
-                                         amount=record['amount'])
+        sync_related_rows(SampleMineral, 'sample_id', 'mineral_id',
+                          {instance.pk: amounts})
 
+        instance.mineral_ids = sorted(amounts)
+        (Sample
+         .objects
+         .filter(pk=instance.pk)
+         .update(mineral_ids=instance.mineral_ids))
 
-    def _handle_references(self, instance, references):
-        to_add = []
-
-        georefences = GeoReference.objects.filter(name__in=references)
-        to_add.extend(georefences)
 
-        missing_georefs = (set(references) -
-                           set([georef.name for georef in georefences]))
-        if missing_georefs:
-            new_georefs = GeoReference.objects.bulk_create(
-                [GeoReference(name=name) for name in missing_georefs]
-            )
-            Reference.objects.bulk_create([Reference(name=name)
-                                           for name in missing_georefs])
-            to_add.extend(new_georefs)
-
-        # FIXME: this is lazy; we should ideally clear only those
-        # associations that aren't needed anymore and create new
-        # associations, if required.
-        instance.references.clear()
-        instance.references.add(*to_add)
+    def _handle_references(self, instance, references):
+        sync_related_rows(
+            Sample.references.through,
+            'sample_id', 'georeference_id',
+            {instance.pk: set(georeference_ids(references).values())})
 
 
     def perform_create(self, serializer):
@@ -199,6 +355,11 @@ class SampleViewSet(viewsets.ModelViewSet):
         if references:
             self._handle_references(instance, references)
 
+        assign_metamorphic_regions(sample_ids=[instance.pk])
+        # the related rows were written after the sample was saved, and
+        # without signals
+        search_cache.invalidate_sample_search(Sample)
+
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data,
                         status=status.HTTP_201_CREATED,
@@ -217,7 +378,7 @@ class SampleViewSet(viewsets.ModelViewSet):
 
         if 'rock_type_id' in params:
             try:
-                rock_type = RockType.objects.get(pk=params['rock_type_id'])
+                rock_type = vocabulary(RockType).get(params['rock_type_id'])
             except RockType.DoesNotExist:
                 return Response(data={'error': 'Invalid rock_type id'},
                                 status=400)
@@ -261,16 +422,19 @@ class SampleViewSet(viewsets.ModelViewSet):
             self._handle_references(instance, params['references'])
 
         instance.save()
+        assign_metamorphic_regions(sample_ids=[instance.pk])
         # refresh the data before returning a response
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
 
-class SubsampleViewSet(viewsets.ModelViewSet):
+class SubsampleViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Subsample.objects.all()
     serializer_class = SubsampleSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,
                           IsOwnerOrReadOnly,)
+    # subsamples are serialized with their sample
+    etag_fields = ('pk', 'version', 'sample_id', 'sample__version')
 
     def get_serializer(self, *args, **kwargs):
         if self.request.method == 'PUT':
@@ -283,13 +447,17 @@ class SubsampleViewSet(viewsets.ModelViewSet):
         params = request.query_params
 
         qs = self.get_queryset().distinct()
-        
+        qs = subsample_qs_optimizer(params, qs)
+
         page = self.paginate_queryset(qs)
+        rows = page if page is not None else list(qs)
+        not_modified = self.check_etag(qs, rows, paginated=page is not None)
+        if not_modified is not None:
+            return not_modified
+
+        serializer = self.get_serializer(rows, many=True)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-      
-        serializer = self.get_serializer(qs, many=True)
         return Response(serializer.data)
 
 
@@ -374,10 +542,50 @@ class CollectorViewSet(viewsets.ModelViewSet):
 
 
 class MetamorphicRegionViewSet(viewsets.ModelViewSet):
+    """
+    Metamorphic regions; `simplify` (low, medium, high or none) or `zoom`
+    picks the level of detail of their shapes, and `geojson=True` lists
+    them as a GeoJSON FeatureCollection.
+    """
     queryset = MetamorphicRegion.objects.all()
     serializer_class = MetamorphicRegionSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,
                           IsSuperuserOrReadOnly,)
+    shape_level = None
+
+    def get_queryset(self):
+        # only the shape at the level of detail asked for is loaded
+        column = shape_column(self.shape_level)
+        return (super()
+                .get_queryset()
+                .defer(*[c for c in SHAPE_COLUMNS if c != column]))
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['shape_level'] = self.shape_level
+        return context
+
+    def list(self, request, *args, **kwargs):
+        try:
+            self.shape_level = shape_level(request.query_params)
+        except ValueError as err:
+            return Response(data={'error': err.args}, status=400)
+
+        if request.query_params.get('geojson') == 'True':
+            qs = self.filter_queryset(self.get_queryset())
+            return StreamingHttpResponse(
+                regions_geojson(qs, self.shape_level),
+                content_type='application/geo+json'
+            )
+
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            self.shape_level = shape_level(request.query_params)
+        except ValueError as err:
+            return Response(data={'error': err.args}, status=400)
+        return super().retrieve(request, *args, **kwargs)
 
 
 class MetamorphicGradeViewSet(viewsets.ModelViewSet):
@@ -394,6 +602,33 @@ class GeoReferenceViewSet(viewsets.ModelViewSet):
                           IsSuperuserOrReadOnly,)
 
 
+class SampleTileView(APIView):
+    """
+    Mapbox Vector Tile of the locations of the samples matching the search
+    parameters, at /api/samples/tiles/{z}/{x}/{y}.mvt
+    """
+    def get(self, request, z, x, y, format=None):
+        z, x, y = int(z), int(x), int(y)
+        if not valid_tile(z, x, y):
+            return Response(data={'error': 'Invalid tile'}, status=400)
+
+        path = tile_path(request, z, x, y)
+        tile = read_tile(path)
+        if tile is None:
+            try:
+                qs = search_samples(request, Sample.objects.all())
+            except ValueError as err:
+                return Response(
+                    data={'error': err.args},
+                    status=400
+                )
+            tile = sample_tile(qs, z, x, y)
+            write_tile(path, tile)
+
+        return HttpResponse(tile,
+                            content_type='application/vnd.mapbox-vector-tile')
+
+
 class SampleNumbersView(APIView):
     def get(self, request, format=None):
         sample_numbers = (
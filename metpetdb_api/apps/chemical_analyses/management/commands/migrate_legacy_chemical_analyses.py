@@ -105,10 +105,13 @@ class Command(BaseCommand):
                 chemical_analysis=record
             ).select_related('element')
 
+            element_ids = set()
             for cae in legacy_cae:
+                element = Element.objects.get(name=cae.element.name)
+                element_ids.add(element.pk)
                 ChemicalAnalysisElement.objects.create(
                     chemical_analysis=chem_analysis,
-                    element=Element.objects.get(name=cae.element.name),
+                    element=element,
                     amount=cae.amount,
                     precision = cae.precision,
                     precision_type = cae.precision_type,
@@ -121,10 +124,13 @@ class Command(BaseCommand):
                 chemical_analysis=record
             ).select_related('oxide')
 
+            oxide_ids = set()
             for cao in legacy_cao:
+                oxide = Oxide.objects.get(species=cao.oxide.species)
+                oxide_ids.add(oxide.pk)
                 ChemicalAnalysisOxide.objects.create(
                     chemical_analysis=chem_analysis,
-                    oxide=Oxide.objects.get(species=cao.oxide.species),
+                    oxide=oxide,
                     amount=cao.amount,
                     precision = cao.precision,
                     precision_type = cao.precision_type,
@@ -133,6 +139,12 @@ class Command(BaseCommand):
                     max_amount = cao.max_amount,
                 )
 
+            (ChemicalAnalysis
+             .objects
+             .filter(pk=chem_analysis.pk)
+             .update(element_ids=sorted(element_ids),
+                     oxide_ids=sorted(oxide_ids)))
+
         if all_references:
             for ref in all_references:
                 Reference.objects.get_or_create(name=ref)
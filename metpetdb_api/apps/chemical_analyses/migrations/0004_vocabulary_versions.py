@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+VOCABULARY_TABLES = ('elements', 'oxides')
+
+CREATE_TRIGGER = """
+CREATE TRIGGER {0}_vocabulary_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0}
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_vocabulary_version();
+"""
+
+DROP_TRIGGER = "DROP TRIGGER {0}_vocabulary_version ON {0};"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0004_vocabulary_versions'),
+        ('chemical_analyses', '0003_chemicalanalysis_stage_y'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGER.format(table),
+                          DROP_TRIGGER.format(table))
+        for table in VOCABULARY_TABLES
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.contrib.postgres.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chemical_analyses', '0004_vocabulary_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chemicalanalysis',
+            name='element_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.UUIDField(), blank=True, default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='chemicalanalysis',
+            name='oxide_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.UUIDField(), blank=True, default=list, size=None),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE chemical_analyses
+            SET element_ids = ARRAY(SELECT DISTINCT cae.element_id
+                                    FROM chemical_analysis_elements cae
+                                    WHERE cae.chemical_analysis_id =
+                                          chemical_analyses.id),
+                oxide_ids = ARRAY(SELECT DISTINCT cao.oxide_id
+                                  FROM chemical_analysis_oxides cao
+                                  WHERE cao.chemical_analysis_id =
+                                        chemical_analyses.id)
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX chemical_analyses_element_ids ON chemical_analyses "
+            "USING gin (element_ids)",
+            "DROP INDEX chemical_analyses_element_ids",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX chemical_analyses_oxide_ids ON chemical_analyses "
+            "USING gin (oxide_ids)",
+            "DROP INDEX chemical_analyses_oxide_ids",
+        ),
+    ]
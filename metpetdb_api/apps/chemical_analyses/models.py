@@ -3,6 +3,7 @@ from concurrency.fields import AutoIncVersionField
 
 from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
 
 
 class ChemicalAnalysis(models.Model):
@@ -30,6 +31,12 @@ class ChemicalAnalysis(models.Model):
     elements = models.ManyToManyField('Element',
                                       through='ChemicalAnalysisElement')
     oxides = models.ManyToManyField('Oxide', through='ChemicalAnalysisOxide')
+    # Ids of the elements and oxides in chemical_analysis_elements and
+    # chemical_analysis_oxides, copied here so that searching by elements or
+    # oxides is a single (GIN indexed) array comparison; whatever writes
+    # those tables has to keep them in sync.
+    element_ids = ArrayField(models.UUIDField(), blank=True, default=list)
+    oxide_ids = ArrayField(models.UUIDField(), blank=True, default=list)
 
     # Free-text field; stored as an CharField to avoid joining to the
     # references table every time we retrieve chemical analyses
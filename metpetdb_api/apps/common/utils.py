@@ -1,4 +1,8 @@
 import gc
+import uuid
+
+from django.db import connections, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
 
 
 def queryset_iterator(queryset, chunksize=1000):
@@ -24,3 +28,162 @@ def queryset_iterator(queryset, chunksize=1000):
             pk = row.pk
             yield row
         gc.collect()
+
+
+def compiled_sql(queryset):
+    """
+    Return the SQL and parameters of a Django Queryset, or None if it can't
+    match any row
+
+    Querysets Django knows to be empty (none(), or filters on an empty
+    list) can't be compiled; they raise EmptyResultSet instead.
+    """
+    try:
+        return queryset.query.get_compiler(using=queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+
+
+def server_side_rows(sql, params, using='default', chunksize=1000):
+    """
+    Stream the rows of a SQL query in lists of chunksize
+
+    The rows are read through a PostgreSQL server-side (named) cursor, so
+    the result set is never materialized in Python memory at once.
+    """
+    connection = connections[using]
+    # named cursors only live as long as the transaction they were opened in
+    with transaction.atomic(using=using):
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+            name='chunks_{}'.format(uuid.uuid4().hex))
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+def server_side_chunks(queryset, chunksize=1000):
+    """
+    Stream the primary keys of a Django Queryset in lists of chunksize
+
+    The keys are read through a server-side cursor (see server_side_rows),
+    while the ordering of the queryset is preserved. Callers are expected
+    to load the rows of each chunk themselves, with whatever prefetching
+    they need.
+    """
+    compiled = compiled_sql(queryset.values_list('pk', flat=True))
+    if compiled is None:
+        return
+    sql, params = compiled
+
+    for rows in server_side_rows(sql, params, using=queryset.db,
+                                 chunksize=chunksize):
+        yield [row[0] for row in rows]
+
+
+
+def sync_related_rows(model, owner, key, wanted, batch_size=1000,
+                      using='default'):
+    """
+    Bring the rows of `model` (typically the through model of a
+    many-to-many relation) of each owner in `wanted` in line with it,
+    touching only the rows that differ
+
+    `wanted` maps each value of the `owner` field (e.g. sample_id) to the
+    values of `key` (e.g. mineral_id) its rows should have: a set, or a
+    dict giving the values of the row's other fields for each key. Rows
+    whose key isn't wanted anymore are deleted with a single query, new
+    ones are inserted with bulk_create, and rows whose other fields
+    changed are updated with bulk_update, one statement per batch. Returns
+    the number of rows added, removed and updated.
+    """
+    wanted = {owner_id: (rows if isinstance(rows, dict)
+                         else {key_value: {} for key_value in rows})
+              for owner_id, rows in wanted.items()}
+    if not wanted:
+        return 0, 0, 0
+    fields = sorted(set(name for rows in wanted.values()
+                        for values in rows.values()
+                        for name in values))
+
+    current = {}
+    for row in (model
+                .objects
+                .using(using)
+                .filter(**{owner + '__in': list(wanted)})
+                .values_list(owner, key, 'pk', *fields)):
+        current[row[:2]] = (row[2], dict(zip(fields, row[3:])))
+
+    removed = [pk for (owner_id, key_value), (pk, _) in current.items()
+               if key_value not in wanted[owner_id]]
+    added = []
+    changed = []
+    for owner_id, rows in wanted.items():
+        for key_value, values in rows.items():
+            if (owner_id, key_value) not in current:
+                added.append(model(**dict(values, **{owner: owner_id,
+                                                     key: key_value})))
+                continue
+            pk, old_values = current[owner_id, key_value]
+            if any(old_values[name] != value
+                   for name, value in values.items()):
+                changed.append((pk, values))
+
+    with transaction.atomic(using=using):
+        if removed:
+            model.objects.using(using).filter(pk__in=removed).delete()
+        model.objects.using(using).bulk_create(added, batch_size=batch_size)
+        # bulk_update sets the same fields on every row of a call
+        by_fields = {}
+        for pk, values in changed:
+            by_fields.setdefault(tuple(sorted(values)), []).append(
+                model(pk=pk, **values))
+        for names, objs in by_fields.items():
+            bulk_update(objs, names, batch_size=batch_size, using=using)
+
+    return len(added), len(removed), len(changed)
+
+
+def bulk_update(objs, fields, batch_size=1000, using='default'):
+    """
+    Update `fields` of the saved model instances `objs` with one UPDATE
+    per batch of batch_size, from a VALUES list of their primary keys and
+    new values
+
+    No signals are sent and no version is checked or bumped, as with
+    QuerySet.update.
+    """
+    if not objs:
+        return
+
+    meta = type(objs[0])._meta
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    columns = [meta.pk] + [meta.get_field(name) for name in fields]
+
+    table = quote(meta.db_table)
+    names = ', '.join(quote(field.column) for field in columns)
+    row = '({})'.format(', '.join('%s::{}'.format(field.db_type(connection))
+                                  for field in columns))
+    assignments = ', '.join('{0} = v.{0}'.format(quote(field.column))
+                            for field in columns[1:])
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            params = [field.get_db_prep_save(getattr(obj, field.attname),
+                                             connection)
+                      for obj in batch for field in columns]
+            cursor.execute(
+                'UPDATE {0} SET {1} FROM (VALUES {2}) AS v ({3}) '
+                'WHERE {0}.{4} = v.{4}'.format(
+                    table, assignments, ', '.join([row] * len(batch)),
+                    names, quote(meta.pk.column)),
+                params)
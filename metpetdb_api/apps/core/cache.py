@@ -0,0 +1,97 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Django creates a backend instance per thread; the entries of a cache are
+# shared by all the threads of the process, keyed by LOCATION
+_entries = {}
+_locks = {}
+
+
+class LRUCache(BaseCache):
+    """
+    Process-local cache backend that evicts the least recently used entry
+    once MAX_ENTRIES is reached, on top of the usual per-entry TIMEOUT.
+
+        CACHES = {
+            'some_cache': {
+                'BACKEND': 'apps.core.cache.LRUCache',
+                'LOCATION': 'some-cache',
+                'TIMEOUT': 60,
+                'OPTIONS': {'MAX_ENTRIES': 1000},
+            },
+        }
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._entries = _entries.setdefault(location, OrderedDict())
+        self._lock = _locks.setdefault(location, threading.Lock())
+
+    def _get(self, key):
+        # the caller holds the lock
+        try:
+            value, expiry = self._entries[key]
+        except KeyError:
+            return None
+        if expiry is not None and expiry <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, timeout):
+        # the caller holds the lock
+        timeout = self.get_backend_timeout(timeout)
+        self._entries[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                              timeout)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
+        timeout = super().get_backend_timeout(timeout)
+        return None if timeout is None else time.time() + timeout
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            value = self._get(key)
+        if value is None:
+            return default
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            return self._get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
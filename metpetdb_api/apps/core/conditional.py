@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def queryset_fingerprint(queryset, fields):
+    """
+    Returns a digest of the values of `fields` over every row of
+    `queryset`, computed in the database, or None if it's empty.
+    """
+    try:
+        sql, params = (queryset
+                       .prefetch_related(None)
+                       .order_by()
+                       .values_list(*fields)
+                       .query
+                       .sql_with_params())
+    except EmptyResultSet:
+        # a queryset Django knows to be empty doesn't compile
+        return None
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(
+            "SELECT md5(string_agg(t::text, ',' ORDER BY t::text)) "
+            "FROM ({}) t".format(sql),
+            params)
+        return cursor.fetchone()[0]
+
+
+def parse_etags(header):
+    etags = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etags.append(etag)
+    return etags
+
+
+class ConditionalGetMixin(object):
+    """
+    Adds ETags to list and detail responses and answers conditional GETs
+    with 304 Not Modified before anything is serialized.
+
+    The ETag of a response is derived from the request (path, query string
+    and rendering format) and from `etag_fields` over the rows it shows;
+    `version` is an AutoIncVersionField, bumped on every save, so that an
+    ETag changes whenever a row is edited, added to or dropped from the
+    result set. `etag_fields` may reach into related rows whose ids or
+    versions are part of the representation.
+
+    Lists are fingerprinted over the rows they show only (the page served,
+    along with the rest of the paginated response: count, links), once
+    they're loaded, so that a conditional GET costs about as much as the
+    response itself. Streamed responses get no ETag.
+    """
+    etag_fields = ('pk', 'version')
+
+    def check_etag(self, queryset, rows=None, paginated=False):
+        """
+        Works out the ETag of this request's response from the rows of
+        `queryset`, or from `rows` if the response shows only those (a
+        page of it, if `paginated`); returns a 304 response if the client's
+        copy is still current, or None if the response has to be built.
+        """
+        request = self.request
+        if rows is None:
+            fingerprint = queryset_fingerprint(queryset,
+                                               self.etag_fields) or ''
+        else:
+            pks = [str(obj.pk) for obj in rows]
+            parts = [','.join(pks)]
+            if paginated:
+                parts.append(json.dumps(self.get_paginated_response([]).data,
+                                        sort_keys=True, default=str))
+            if pks:
+                parts.append(queryset_fingerprint(
+                    queryset.filter(pk__in=pks), self.etag_fields) or '')
+            fingerprint = '\n'.join(parts)
+        key = '\n'.join([
+            type(self).__name__,
+            request.get_full_path(),
+            request.accepted_renderer.format,
+            fingerprint,
+        ])
+        self.etag = '"{}"'.format(hashlib.md5(key.encode('utf-8'))
+                                  .hexdigest())
+        return self.not_modified()
+
+    def not_modified(self):
+        """
+        Returns a 304 response if the client's copy matches `self.etag`, or
+        None otherwise.
+        """
+        etags = parse_etags(self.request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if self.etag in etags or '*' in etags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return None
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        not_modified = self.check_etag(
+            self.get_queryset().filter(pk=instance.pk))
+        if not_modified is not None:
+            return not_modified
+
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response,
+                                             *args, **kwargs)
+        etag = getattr(self, 'etag', None)
+        if etag and response.status_code in (status.HTTP_200_OK,
+                                             status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+        return response
@@ -1,6 +1,277 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import (
+    EmptyPage,
+    Page,
+    PageNotAnInteger,
+    Paginator,
+)
+from django.db import connections
+from django.db.models import Model, Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.functional import cached_property
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
 
 class StandardResultsSetPagination(pagination.PageNumberPagination):
     page_size = 20
     page_size_query_param = 'page_size'
     max_page_size = 1000
+
+
+def estimate_count(queryset):
+    """
+    Returns the planner's estimate of the number of rows of `queryset`, as
+    given by EXPLAIN; it's read from the table statistics (pg_class and
+    pg_stats), without running the query.
+    """
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        # Django knows there's no row; such querysets don't compile
+        return 0
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class EstimatedCountPage(Page):
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A Paginator that counts the rows exactly only when the planner
+    estimates there are at most `estimate_threshold` of them, and goes
+    with the estimate otherwise. Pages are then checked for a next page by
+    fetching one more row, rather than by comparing with the count.
+    """
+    estimate_threshold = 10000
+
+    @cached_property
+    def count_is_estimate(self):
+        return self.estimate > self.estimate_threshold
+
+    @cached_property
+    def estimate(self):
+        return estimate_count(self.object_list)
+
+    @cached_property
+    def count(self):
+        if self.count_is_estimate:
+            return self.estimate
+        return self.object_list.count()
+
+    def validate_number(self, number):
+        if not self.count_is_estimate:
+            return super().validate_number(number)
+        # pages past the estimated count may still have rows
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        if not self.count_is_estimate:
+            return super().page(number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        return EstimatedCountPage(rows[:self.per_page], number, self,
+                                  has_next=len(rows) > self.per_page)
+
+
+class EstimatedCountPagination(StandardResultsSetPagination):
+    """
+    Page number pagination whose count may be a planner estimate, for
+    broad searches where counting the rows costs more than fetching a
+    page; `count_is_estimate` tells if it is.
+    """
+    django_paginator_class = EstimatedCountPaginator
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.paginator.count),
+            ('count_is_estimate', self.page.paginator.count_is_estimate),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    Keyset (a.k.a. seek) pagination over (ordering key, pk).
+
+    Every page is fetched with a `WHERE (key, pk) > (last key, last pk)`
+    style predicate instead of an OFFSET, and no COUNT is issued, so each
+    page costs the same no matter how deep into the result set it is. The
+    ordering key is taken from the `ordering` query parameter; the primary
+    key breaks ties so that the ordering is total. Only the fields listed
+    in the view's `ordering_fields` may be ordered by. Cursors are opaque.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    invalid_cursor_message = 'Invalid cursor'
+    ordering_fields = ('pk',)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.model = queryset.model
+        self.page_size = self.get_page_size(request)
+        self.ordering = request.query_params.get(self.ordering_query_param,
+                                                 'pk')
+        self.descending = self.ordering.startswith('-')
+        self.key = self.ordering[1:] if self.descending else self.ordering
+
+        ordering_fields = getattr(view, 'ordering_fields',
+                                  self.ordering_fields)
+        if self.key not in ordering_fields:
+            raise ValidationError(
+                {self.ordering_query_param:
+                 'Invalid ordering: {}'.format(self.ordering)})
+
+        direction = '-' if self.descending else ''
+        if self.key == 'pk':
+            queryset = queryset.order_by(direction + 'pk')
+        else:
+            queryset = queryset.order_by(direction + self.key,
+                                         direction + 'pk')
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = queryset.filter(self.seek(*self.decode_cursor(encoded)))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def seek(self, value, pk):
+        """
+        Returns the predicate selecting the rows that come strictly after
+        (value, pk). PostgreSQL sorts NULLs last in ascending order and
+        first in descending order, which is taken into account here.
+        """
+        op = 'lt' if self.descending else 'gt'
+        after_pk = Q(**{'pk__' + op: pk})
+        if self.key == 'pk':
+            return after_pk
+
+        is_null = Q(**{self.key + '__isnull': True})
+        if value is None:
+            if self.descending:
+                return ~is_null | (is_null & after_pk)
+            return is_null & after_pk
+
+        after_value = (Q(**{self.key + '__' + op: value}) |
+                       (Q(**{self.key: value}) & after_pk))
+        if self.descending:
+            return after_value
+        return after_value | is_null
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_key_value(self, obj):
+        value = obj
+        for attr in self.key.split('__'):
+            if value is None:
+                break
+            value = getattr(value, attr)
+        if isinstance(value, Model):
+            value = value.pk
+        return None if value is None else str(value)
+
+    def encode_cursor(self, obj):
+        cursor = [self.ordering, self.get_key_value(obj), str(obj.pk)]
+        return (base64
+                .urlsafe_b64encode(json.dumps(cursor).encode('utf-8'))
+                .decode('ascii'))
+
+    def decode_cursor(self, encoded):
+        try:
+            ordering, value, pk = json.loads(
+                base64.urlsafe_b64decode(encoded.encode('ascii'))
+                .decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # a cursor is only meaningful for the ordering it was created with
+        if ordering != self.ordering:
+            raise NotFound(self.invalid_cursor_message)
+
+        meta = self.model._meta
+        key_field = meta.pk if self.key == 'pk' else meta.get_field(self.key)
+        try:
+            if value is not None:
+                value = key_field.to_python(value)
+            pk = meta.pk.to_python(pk)
+        except (DjangoValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if pk is None:
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url,
+                                   self.cursor_query_param,
+                                   self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+
+class PaginationModeMixin(object):
+    """
+    Lets clients pick a pagination mode with the `pagination` query
+    parameter; the view's `pagination_class` is used otherwise.
+    """
+    pagination_modes = {
+        'cursor': KeysetPagination,
+        'estimated': EstimatedCountPagination,
+    }
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            mode = self.request.query_params.get('pagination')
+            pagination_class = self.pagination_modes.get(mode,
+                                                         self.pagination_class)
+            self._paginator = pagination_class() if pagination_class else None
+        return self._paginator
@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+
+from apps.samples.regions import assign_metamorphic_regions
+
+
+class Command(BaseCommand):
+    help = ('Links every sample to the metamorphic regions whose shape '
+            'contains its location')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--region', action='append', dest='regions',
+                            help='only reprocess this region (by id); may '
+                                 'be repeated')
+
+    def handle(self, *args, **options):
+        added, removed = assign_metamorphic_regions(
+            region_ids=options['regions'])
+        self.stdout.write('{} links added, {} removed'.format(added, removed))
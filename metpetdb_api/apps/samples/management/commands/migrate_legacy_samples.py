@@ -161,6 +161,11 @@ class Command(BaseCommand):
                                              mineral=mineral,
                                              amount=old_sample_mineral.amount)
 
+            (Sample
+             .objects
+             .filter(pk=new_sample.pk)
+             .update(mineral_ids=[mineral.pk for mineral in new_minerals]))
+
 
         Region.objects.all().delete()
         Region.objects.bulk_create([Region(name=region)
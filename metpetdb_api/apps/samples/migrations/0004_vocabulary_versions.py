@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+VOCABULARY_TABLES = ('rock_types', 'minerals', 'metamorphic_grades',
+                     'metamorphic_regions')
+
+CREATE_VOCABULARY_VERSIONS = """
+CREATE SEQUENCE vocabulary_version_seq;
+
+CREATE TABLE vocabulary_versions (
+    name varchar(100) PRIMARY KEY,
+    version bigint NOT NULL
+);
+
+CREATE FUNCTION bump_vocabulary_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO vocabulary_versions (name, version)
+    VALUES (TG_TABLE_NAME, nextval('vocabulary_version_seq'))
+    ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+DROP_VOCABULARY_VERSIONS = """
+DROP FUNCTION bump_vocabulary_version();
+DROP TABLE vocabulary_versions;
+DROP SEQUENCE vocabulary_version_seq;
+"""
+
+CREATE_TRIGGER = """
+CREATE TRIGGER {0}_vocabulary_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0}
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_vocabulary_version();
+"""
+
+DROP_TRIGGER = "DROP TRIGGER {0}_vocabulary_version ON {0};"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0003_bulk_upload_jobs'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_VOCABULARY_VERSIONS,
+                          DROP_VOCABULARY_VERSIONS),
+    ] + [
+        migrations.RunSQL(CREATE_TRIGGER.format(table),
+                          DROP_TRIGGER.format(table))
+        for table in VOCABULARY_TABLES
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.contrib.postgres.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0004_vocabulary_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sample',
+            name='mineral_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.UUIDField(), blank=True, default=list, size=None),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE samples
+            SET mineral_ids = ARRAY(SELECT DISTINCT sm.mineral_id
+                                    FROM sample_minerals sm
+                                    WHERE sm.sample_id = samples.id)
+            WHERE EXISTS (SELECT 0
+                          FROM sample_minerals sm
+                          WHERE sm.sample_id = samples.id)
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX samples_mineral_ids ON samples "
+            "USING gin (mineral_ids)",
+            "DROP INDEX samples_mineral_ids",
+        ),
+    ]
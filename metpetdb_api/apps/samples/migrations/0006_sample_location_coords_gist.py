@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Databases created by Django already have a GiST index on location_coords
+# (PointField.spatial_index); databases restored from dumps of the legacy
+# schema may not, so one is created only if none exists.
+CREATE_INDEX = """
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 0
+        FROM pg_index i
+        INNER JOIN pg_class c ON c.oid = i.indexrelid
+        INNER JOIN pg_am am ON am.oid = c.relam
+        INNER JOIN pg_attribute a
+        ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = 'samples'::regclass
+        AND a.attname = 'location_coords'
+        AND am.amname = 'gist'
+    ) THEN
+        CREATE INDEX samples_location_coords_gist
+        ON samples USING gist (location_coords);
+    END IF;
+END
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0005_sample_mineral_ids'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_INDEX,
+                          "DROP INDEX IF EXISTS samples_location_coords_gist"),
+        migrations.RunSQL("ANALYZE samples", migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+# tolerances in degrees, below a pixel at the highest zoom level each shape
+# is used for (see api.samples.lib.regions.SHAPE_LEVELS)
+CREATE_TRIGGER = """
+CREATE FUNCTION simplify_metamorphic_region_shape() RETURNS trigger AS $$
+BEGIN
+    NEW.shape_low := ST_SimplifyPreserveTopology(NEW.shape, 0.05);
+    NEW.shape_medium := ST_SimplifyPreserveTopology(NEW.shape, 0.005);
+    NEW.shape_high := ST_SimplifyPreserveTopology(NEW.shape, 0.0005);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER metamorphic_regions_simplified_shapes
+BEFORE INSERT OR UPDATE ON metamorphic_regions
+FOR EACH ROW EXECUTE PROCEDURE simplify_metamorphic_region_shape();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER metamorphic_regions_simplified_shapes ON metamorphic_regions;
+DROP FUNCTION simplify_metamorphic_region_shape();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0006_sample_location_coords_gist'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metamorphicregion',
+            name='shape_low',
+            field=django.contrib.gis.db.models.fields.GeometryField(blank=True, editable=False, null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='metamorphicregion',
+            name='shape_medium',
+            field=django.contrib.gis.db.models.fields.GeometryField(blank=True, editable=False, null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='metamorphicregion',
+            name='shape_high',
+            field=django.contrib.gis.db.models.fields.GeometryField(blank=True, editable=False, null=True, srid=4326),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        # fires the trigger on the existing regions
+        migrations.RunSQL("UPDATE metamorphic_regions SET shape = shape",
+                          migrations.RunSQL.noop),
+    ]
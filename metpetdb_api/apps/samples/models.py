@@ -3,11 +3,51 @@ from concurrency.fields import AutoIncVersionField
 
 from django.conf import settings
 from django.contrib.gis.db import models
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from apps.chemical_analyses.models import Element, Oxide
 
 class BulkUpload(models.Model):
-    pass
+    """
+    A bulk upload job; see api.bulk_upload.v1.jobs for how these are queued
+    and processed.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL,
+                              related_name='bulk_uploads',
+                              blank=True,
+                              null=True)
+    template = models.CharField(max_length=50, blank=True, null=True)
+    url = models.TextField(blank=True, null=True)
+    # corrected rows resubmitted by the client, in place of a file
+    data = JSONField(blank=True, null=True)
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=QUEUED)
+    total_rows = models.IntegerField(blank=True, null=True)
+    processed_rows = models.IntegerField(default=0)
+    # the uploaded rows annotated with their errors, once processed
+    result = JSONField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True, null=True)
+    started = models.DateTimeField(blank=True, null=True)
+    # touched periodically by the worker running the job
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    # the number of times a worker took the job on
+    attempts = models.IntegerField(default=0)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'bulk_uploads'
 
 class RockType(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -37,6 +77,10 @@ class Sample(models.Model):
     metamorphic_grades = models.ManyToManyField('MetamorphicGrade')
     minerals = models.ManyToManyField('Mineral', through='SampleMineral',
                                       related_name='samples')
+    # Ids of the minerals in sample_minerals, copied here so that searching
+    # by minerals is a single (GIN indexed) array comparison; whatever
+    # writes sample_minerals has to keep it in sync.
+    mineral_ids = ArrayField(models.UUIDField(), blank=True, default=list)
     references = models.ManyToManyField('GeoReference', related_name='samples')
 
     # Free-text field. Ugh. Stored as an CharField to avoid joining to the
@@ -113,6 +157,11 @@ class MetamorphicRegion(models.Model):
     shape = models.GeometryField(blank=True, null=True)
     description = models.TextField(blank=True, null=True)
     label_location = models.GeometryField(blank=True, null=True)
+    # shape simplified for smaller map scales, kept up to date by a trigger
+    # (see migration 0007)
+    shape_low = models.GeometryField(blank=True, null=True, editable=False)
+    shape_medium = models.GeometryField(blank=True, null=True, editable=False)
+    shape_high = models.GeometryField(blank=True, null=True, editable=False)
 
     class Meta:
         db_table = 'metamorphic_regions'
@@ -0,0 +1,66 @@
+from django.db import connections, transaction
+
+from apps.samples.models import Sample
+
+
+def assign_metamorphic_regions(sample_ids=None, region_ids=None,
+                               using='default'):
+    """
+    Links samples to the metamorphic regions whose shape contains their
+    location, and unlinks them from the regions whose shape doesn't;
+    regions without a shape keep whatever samples they were given.
+
+    Only the samples of `sample_ids` and/or the regions of `region_ids` are
+    considered if they're given. Either way it takes two set-based
+    statements: the spatial indexes of location_coords and shape pick the
+    candidate pairs, and PostGIS prepares each region's shape once for all
+    the points it's tested against. The version of every sample whose
+    links changed is bumped, as its representation (and ETag) did.
+
+    Returns the number of links added and removed.
+    """
+    table = Sample.metamorphic_regions.through._meta.db_table
+
+    scope = ''
+    params = []
+    if sample_ids is not None:
+        scope += ' AND s.id = ANY(%s::uuid[])'
+        params.append([str(id) for id in sample_ids])
+    if region_ids is not None:
+        scope += ' AND r.id = ANY(%s::uuid[])'
+        params.append([str(id) for id in region_ids])
+
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM {0} sr
+                USING samples s, metamorphic_regions r
+                WHERE sr.sample_id = s.id
+                AND sr.metamorphicregion_id = r.id
+                AND r.shape IS NOT NULL
+                AND NOT ST_Intersects(r.shape, s.location_coords){1}
+                RETURNING sr.sample_id
+            """.format(table, scope), params)
+            removed = cursor.fetchall()
+
+            cursor.execute("""
+                INSERT INTO {0} (sample_id, metamorphicregion_id)
+                SELECT s.id, r.id
+                FROM metamorphic_regions r
+                INNER JOIN samples s
+                ON ST_Intersects(r.shape, s.location_coords)
+                WHERE true{1}
+                ON CONFLICT DO NOTHING
+                RETURNING sample_id
+            """.format(table, scope), params)
+            added = cursor.fetchall()
+
+            changed = set(str(row[0]) for row in added + removed)
+            if changed:
+                cursor.execute("""
+                    UPDATE samples
+                    SET version = version + 1
+                    WHERE id = ANY(%s::uuid[])
+                """, [list(changed)])
+
+    return len(added), len(removed)
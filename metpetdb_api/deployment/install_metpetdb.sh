@@ -222,6 +222,7 @@ collect_static(){
 database_migrations(){
     sudo -u postgres sh -c "psql -c 'ALTER ROLE $metpetdb_user SUPERUSER;'"
     migrate "migrate"
+    migrate "createcachetable"
     sudo -u postgres sh -c "psql -c 'ALTER ROLE $metpetdb_user NOSUPERUSER;'"
     printf "Finished migrating schema\n\n"
 
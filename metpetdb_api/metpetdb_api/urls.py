@@ -42,6 +42,7 @@ from api.samples.v1.views import (
     SampleNumbersView,
     CountryNamesView,
     SampleOwnerNamesView,
+    SampleTileView,
 )
 from api.users.v1.views import UserViewSet
 
@@ -69,6 +70,8 @@ router.register(r'bulk_upload', BulkUploadViewSet)
 
 
 urlpatterns = [
+    url(r'^api/samples/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        SampleTileView.as_view()),
     url(r'^api/', include(router.urls)),
     url(r'^api/admin/', include(admin.site.urls)),
     url(r'^api/auth/', include('djoser.urls.authtoken')),
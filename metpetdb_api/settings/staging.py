@@ -156,6 +156,35 @@ LOGGING = {
     },
 }
 
+# Caches
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Sample search responses (see api.samples.lib.search_cache). Cached
+    # responses carry their ETags, and writes are announced through the
+    # cache itself, so it has to be shared by every worker: the default is
+    # a table of the database (created by `manage.py createcachetable`).
+    # A process-local backend such as apps.core.cache.LRUCache would serve
+    # stale responses, and wrong 304s, from the workers that didn't see a
+    # write; only use one with a single worker.
+    'sample_search': {
+        'BACKEND': env('SAMPLE_SEARCH_CACHE_BACKEND',
+                       'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': env('SAMPLE_SEARCH_CACHE_LOCATION', 'sample_search_cache'),
+        'TIMEOUT': 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+# Sample map tiles are cached on disk in this directory (see
+# api.samples.lib.tiles); they aren't cached if it's empty.
+SAMPLE_TILE_CACHE_DIR = env('SAMPLE_TILE_CACHE_DIR', '')
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 